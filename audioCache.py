@@ -0,0 +1,127 @@
+"""
+Author: Raghavasimhan Sankaranarayanan
+Date created: 03/03/24
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from typing import Tuple
+import numpy as np
+from definitions import AUDIO_CACHE_BYTES
+from wavSource import WavSource
+from resampler import Resampler
+from haptics import HapticRenderer
+
+
+class AudioCache:
+    """
+    LRU cache of audio keyed by audio path, sample rate and modification time: decoded PCM (get) or the haptic track
+    rendered from it (get_haptic), which is what Performance plays.
+    Entries are evicted least recently used first once the total size exceeds max_bytes.
+    Songs requested at a different sample rate than their file are resampled once and cached at that rate.
+    """
+    def __init__(self, max_bytes: int = AUDIO_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[tuple, Tuple[int, np.ndarray, int]] = OrderedDict()
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return f"AudioCache: {len(self.entries)} songs, {self.size / 2 ** 20:.1f}/{self.max_bytes / 2 ** 20:.1f} MB, " \
+               f"hits: {self.hits}, misses: {self.misses}, evictions: {self.evictions}"
+
+    def get(self, path: str, fs: int = None) -> Tuple[np.ndarray, int]:
+        """
+        Return the decoded audio for path, reading it from disk only on a miss
+        :param path: path of the .wav
+        :param fs: sample rate to convert to. None keeps the file's sample rate
+        :return: samples with shape (num_frames, channels) and their sample rate
+        """
+        mtime = os.stat(path).st_mtime_ns
+        key = (path, fs)
+        entry = self.lookup(key, mtime)
+        if entry:
+            return entry[1], entry[2]
+
+        data, fs = self.decode(path, fs)
+        return self.store(key, mtime, data, fs), fs
+
+    def get_haptic(self, path: str, renderer: HapticRenderer, persist=True) -> np.ndarray:
+        """
+        Return the haptic track of path. On a miss it is loaded from its sidecar, and the audio is only decoded if
+        the sidecar has to be rendered. The decoded audio itself is not cached
+        :param path: path of the .wav
+        :param renderer: renders the track at its sample rate
+        :param persist: whether to write the sidecar when rendering
+        :return: samples with shape (num_frames, 2) at renderer.fs
+        """
+        mtime = os.stat(path).st_mtime_ns
+        key = (path, renderer.fs, renderer.config_hash)
+        entry = self.lookup(key, mtime)
+        if entry:
+            return entry[1]
+
+        track = renderer.load_or_render(path, lambda: self.decode(path, renderer.fs)[0], persist=persist)
+        return self.store(key, mtime, track, renderer.fs)
+
+    def lookup(self, key: tuple, mtime: int):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] == mtime:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+        return None
+
+    @staticmethod
+    def decode(path: str, fs: int = None) -> Tuple[np.ndarray, int]:
+        src = WavSource(path)
+        data = src.data
+        if fs is not None and fs != src.fs:
+            data = Resampler.resample(data, src.fs, fs)
+        else:
+            fs = src.fs
+        return data, fs
+
+    def store(self, key: tuple, mtime: int, data: np.ndarray, fs: int) -> np.ndarray:
+        if data.nbytes > self.max_bytes:
+            # Too big to cache. Play straight from the memory map or the rendered copy
+            return data
+
+        data = np.array(data)
+        data.flags.writeable = False
+        self.put(key, mtime, data, fs)
+        return data
+
+    def put(self, key: tuple, mtime: int, data: np.ndarray, fs: int):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old:
+                self.size -= old[1].nbytes
+
+            self.entries[key] = (mtime, data, fs)
+            self.size += data.nbytes
+
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                _, (_, evicted, _) = self.entries.popitem(last=False)
+                self.size -= evicted.nbytes
+                self.evictions += 1
+
+    def open(self, path: str, fs: int = None) -> WavSource:
+        """
+        WavSource over the cached audio with its own read cursor
+        """
+        data, fs = self.get(path, fs)
+        return WavSource.from_array(data, fs, path)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
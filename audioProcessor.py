@@ -4,70 +4,90 @@ Date created: 03/03/24
 """
 
 import time
-import wave
-from definitions import OUTPUT_AUDIO_DEVICE
+from definitions import FADE_MS
+from wavSource import WavSource
+from audioSink import AudioSink, PyAudioSink
+from audioCache import AudioCache
+from resampler import Resampler, ResamplingSource
+from fader import Fader
+from audioStats import AudioStats
 import numpy as np
-import pyaudio
 import threading
 
 
 class AudioProcessor:
-    def __init__(self, chunk_size=256, sample_rate=44100, audio_callback=None, complete_callback=None):
+    def __init__(self, chunk_size=256, sample_rate=44100, audio_callback=None, complete_callback=None,
+                 preallocate=True, callback_stream=False, buffer_chunks=4, audio_cache: AudioCache = None,
+                 decode_chunks=True, stream_resample=False, fade_ms=FADE_MS, sink: AudioSink = None):
         self.chunk_size = chunk_size
         self.fs = sample_rate
         self.callback = audio_callback
+        # If False, the callback gets the raw sample view of each chunk and the chunk is written unchanged
+        self.decode_chunks = decode_chunks
         self.complete_callback = complete_callback
 
         self.audio_path = None
+        self.audio_cache = audio_cache
+        # Resample mismatched songs chunk by chunk while playing instead of converting the whole song up front
+        self.stream_resample = stream_resample
 
-        self.pya = pyaudio.PyAudio()
-        self.stream: pyaudio.Stream or None = None
+        # Where encoded chunks go. Defaults to the PyAudio output device
+        self.sink = sink if sink else PyAudioSink(chunk_size, callback_stream, buffer_chunks)
         self.is_playing = False
 
-        # pause functionality
+        # pause functionality. Setting fade starts a fade in or out (depending on paused) on the next chunk
         self.paused = False
         self.fade = False
+        self.fade_ms = fade_ms
+        self.fader: Fader or None = None
+
+        # preallocated per-stream work buffers used by decode_into / encode_into
+        self.preallocate = preallocate
+        self._work_buffer: np.ndarray or None = None
+        self._out_buffer: np.ndarray or None = None
+        self._out_bytes: memoryview or None = None
 
         self.play_idx = 0
-        self.mutex = threading.Lock()
         self.play_thread = None
 
-        self.output_device_id = 0
-        self.config_device()
+        # per-chunk timing, see AudioStats. Query at runtime with stats / underruns
+        self.stats = AudioStats()
+        self.reported = False
+
+        # Frame of the song the callback's current chunk starts at. Jumps when seek is applied
+        self.position = 0
+        self.pending_seek: float or None = None
 
     def __del__(self):
-        self.terminate()
+        # Nothing is printed here: at interpreter exit numpy can no longer import what the summary needs
+        self.terminate(report=False)
 
-    def terminate(self):
+    @property
+    def underruns(self):
+        return self.sink.underruns
+
+    def terminate(self, report=True):
+        """
+        :param report: print the stats summary, once however many times this is called
+        """
         self.stop()
-        self.stop_stream()
-        self.pya.terminate()
-
-    def config_device(self):
-        print("----------------------device list---------------------")
-        info = self.pya.get_host_api_info_by_index(0)
-        num_devices = info.get('deviceCount')
-        for i in range(num_devices):
-            dev_info = self.pya.get_device_info_by_host_api_device_index(0, i)
-            if (dev_info.get('maxOutputChannels')) > 0:
-                name = dev_info.get('name')
-                print(name)
-                if name == OUTPUT_AUDIO_DEVICE:
-                    self.output_device_id = i
-                    print(f"Output device set to '{name}' with id {self.output_device_id}")
-        print("-------------------------------------------------------------")
+        if report and not self.reported and self.stats.count:
+            print(self.stats.summary(self.underruns))
+            self.reported = True
+        self.sink.terminate()
 
     @staticmethod
     def dtype2width(dtype) -> int:
         """
-        For a given dtype, return number of "bits"
-        :param dtype: can be np.int16 or float
+        For a given dtype, return number of "bits". Derived from numpy so that no audio backend is needed
+        :param dtype: integer sample type such as np.int16, or float
         :return: number of bits
         """
-        if dtype == float or dtype == pyaudio.paFloat32:
+        dtype = np.dtype(dtype)
+        if np.issubdtype(dtype, np.floating):
             return 32
-        if dtype == np.int16 or dtype == pyaudio.paInt16:
-            return 16
+        if np.issubdtype(dtype, np.integer):
+            return dtype.itemsize * 8
         return -1
 
     @staticmethod
@@ -108,12 +128,70 @@ class AudioProcessor:
         interleaved = interleaved * (2 ** (w - 1))
         return interleaved.astype(dtype).tobytes()
 
-    def play(self, audio_file_path: str, delay_ms=0, block=False):
+    @staticmethod
+    def decode_into(data, out: np.ndarray, dtype):
+        """
+        Same as decode, but writes the float samples into the preallocated out buffer with shape
+        (chunk_size, channels) instead of allocating. Returns a view of out trimmed to the number of frames in data
+        """
+        samples = np.frombuffer(data, dtype=dtype)
+        channels = out.shape[1]
+        assert len(samples) % channels == 0
+        n = len(samples) // channels
+
+        w = AudioProcessor.dtype2width(dtype)
+        view = out[:n]
+        np.multiply(samples.reshape((n, channels)), 1.0 / (2 ** (w - 1)), out=view, casting='unsafe')
+        return view
+
+    @staticmethod
+    def encode_into(data: np.ndarray, out: np.ndarray, out_bytes: memoryview):
+        """
+        Same as encode, but scales data in place and writes the samples into the preallocated out buffer.
+        Returns a read-only byte view of out that PyAudio can write directly
+        :param data: float samples with shape (n, channels). Will be overwritten
+        :param out: integer buffer with shape (chunk_size, channels)
+        :param out_bytes: read-only byte view of out
+        """
+        n = len(data)
+        w = AudioProcessor.dtype2width(out.dtype)
+        scale = 2 ** (w - 1)
+        np.multiply(data, scale, out=data)
+        np.clip(data, -scale, scale - 1, out=data)
+        np.copyto(out[:n], data, casting='unsafe')
+        return out_bytes if n == len(out) else out_bytes[:n * out.shape[1] * out.itemsize]
+
+    def alloc_buffers(self, channels, dtype):
+        """
+        Allocate the work buffers once per stream. Only integer formats are converted in place
+        :return: True if the buffers can be used for this stream
+        """
+        if not self.preallocate or dtype != np.int16:
+            self._work_buffer = self._out_buffer = self._out_bytes = None
+            return False
+
+        shape = (self.chunk_size, channels)
+        if self._work_buffer is None or self._work_buffer.shape != shape:
+            self._work_buffer = np.zeros(shape, dtype=np.float32)
+            self._out_buffer = np.zeros(shape, dtype=dtype)
+            self._out_bytes = memoryview(self._out_buffer).cast('B').toreadonly()
+        return True
+
+    def play(self, audio_file_path: str, delay_ms=0, block=False, start_sec=0, source: WavSource = None):
+        """
+        Play a song, or resume it if it is the paused one
+        :param audio_file_path: path of the song's audio. Also identifies the song for resuming
+        :param delay_ms: delay before the audio starts. If negative, the callback is delayed instead
+        :param block: wait for the song to finish
+        :param start_sec: offset into the song to start from
+        :param source: play these samples instead of reading audio_file_path, e.g. a prerendered track
+        """
         if self.paused and self.audio_path == audio_file_path:
             self.paused = False
             self.fade = True
         else:
-            self.play_thread = threading.Thread(target=self.play_handler, args=(audio_file_path, delay_ms))
+            self.play_thread = threading.Thread(target=self.play_handler,
+                                                args=(audio_file_path, delay_ms, start_sec, source))
             self.play_thread.start()
             if block:
                 self.play_thread.join()
@@ -122,65 +200,119 @@ class AudioProcessor:
         self.is_playing = False
         self.paused = False
         self.fade = False
+        self.pending_seek = None
+        self.sink.abort()
 
         if join:
             if self.play_thread and self.play_thread.is_alive():
                 self.play_thread.join()
 
-    def stop_stream(self):
-        with self.mutex:
-            if self.stream:
-                self.stream.stop_stream()
-                self.stream.close()
-
     def pause(self):
         self.paused = True
         self.fade = True
 
-    def play_handler(self, audio_file_path, delay_ms):
+    def seek(self, seconds: float):
+        """
+        Move the playing song to seconds. Applied by the play thread before it reads the next chunk.
+        The callback sees the jump through self.position
+        """
+        self.pending_seek = max(seconds, 0)
+
+    @staticmethod
+    def as_bytes(data: np.ndarray):
+        """
+        Read-only byte view of a C contiguous array that PyAudio can write without a copy
+        """
+        return memoryview(data).cast('B').toreadonly()
+
+    def play_handler(self, audio_file_path, delay_ms, start_sec=0, source: WavSource = None):
         self.audio_path = audio_file_path
         delay_gestures = delay_ms < 0
         delay = abs(delay_ms / 1000.0)
         self.is_playing = True
         play_idx = 0
 
-        self.stop_stream()
-
-        with wave.open(self.audio_path, "rb") as wf:
-            if wf.getframerate() != self.fs:
-                print(f"Warning: Sample rate mismatch. ({self.fs}), ({wf.getframerate()})")
-
-            self.stream = self.pya.open(rate=self.fs,
-                                        channels=wf.getnchannels(),
-                                        format=self.pya.get_format_from_width(wf.getsampwidth()),
-                                        input=False, output=True,
-                                        frames_per_buffer=self.chunk_size)
+        self.sink.close()
 
-            chunk_duration_sec = self.chunk_size / self.fs
-            num_dly_chunks = int(round(delay / chunk_duration_sec))
-            zeros = np.zeros((self.chunk_size * wf.getnchannels()), dtype=np.int16).tobytes()
-            data = zeros[:]
-
-            if not self.paused:
-                data = zeros if play_idx < num_dly_chunks and not delay_gestures else wf.readframes(self.chunk_size)
-
-            while len(data) and self.is_playing:
-                if self.callback and not delay_gestures and not self.paused:
-                    dtype = self.width2dtype(wf.getsampwidth())
-                    data = self.decode(data, wf.getnchannels(), dtype)
+        if source:
+            src = source
+        elif self.audio_cache and not self.stream_resample:
+            src = self.audio_cache.open(self.audio_path, fs=self.fs)
+        else:
+            src = WavSource(self.audio_path)
+
+        if src.fs != self.fs:
+            if self.stream_resample:
+                src = ResamplingSource(src, self.fs, chunk_size=self.chunk_size)
+            else:
+                src = WavSource.from_array(Resampler.resample(src.data, src.fs, self.fs), self.fs, self.audio_path)
+        src.seek_sec(start_sec)
+        position = src.tell()
+
+        def read():
+            nonlocal position
+            if self.pending_seek is not None:
+                src.seek_sec(self.pending_seek)
+                self.pending_seek = None
+                position = src.tell()
+            return src.read(self.chunk_size)
+
+        self.sink.open(self.fs, self.chunk_size, src.channels, src.sampwidth, src.dtype)
+
+        chunk_duration_sec = self.chunk_size / self.fs
+        num_dly_chunks = int(round(delay / chunk_duration_sec))
+        zeros = np.zeros((self.chunk_size, src.channels), dtype=src.dtype)
+        data = zeros
+
+        if not self.paused:
+            data = zeros if play_idx < num_dly_chunks and not delay_gestures else read()
+
+        dtype = src.dtype
+        in_place = self.alloc_buffers(src.channels, dtype)
+        if not self.fader or not self.fader.matches(self.chunk_size, src.channels, dtype, self.fade_ms, self.fs):
+            self.fader = Fader(self.chunk_size, src.channels, dtype, self.fade_ms, self.fs)
+        self.fader.reset()
+
+        self.stats.reset(chunk_duration_sec)
+        while len(data) and self.is_playing:
+            t = time.perf_counter()
+            # Keep playing through a pause until the fade out is done
+            if self.callback and not delay_gestures and (not self.paused or self.fader.fading_out):
+                self.position = position
+                position += len(data)
+                if not self.decode_chunks:
+                    self.callback(data)
+                    data = self.as_bytes(data)
+                elif in_place:
+                    data = self.decode_into(data, self._work_buffer, dtype)
+                    data = self.callback(data)
+                    data = self.encode_into(data, self._out_buffer, self._out_bytes)
+                else:
+                    data = self.decode(data, src.channels, dtype)
                     data = self.callback(data)
                     data = self.encode(data, dtype)
-                with self.mutex:
-                    try:
-                        self.stream.write(data)
-                    except OSError:
-                        break
-
-                data = zeros[:]
-                if not self.paused:
-                    play_idx += 1
-                    data = zeros[:] if play_idx < num_dly_chunks and not delay_gestures \
-                        else wf.readframes(self.chunk_size)
-
-                if play_idx >= num_dly_chunks:
-                    delay_gestures = False
+            else:
+                data = self.as_bytes(data)
+
+            data = self.fader.apply(data)
+            t_write = time.perf_counter()
+            if not self.sink.write(data):
+                break
+            self.stats.record(t_write - t, time.perf_counter() - t_write, realtime=self.sink.realtime)
+
+            if self.fade:
+                self.fade = False
+                self.fader.start(fade_in=not self.paused)
+
+            data = zeros
+            if not self.paused or self.fader.fading_out:
+                play_idx += 1
+                data = zeros if play_idx < num_dly_chunks and not delay_gestures else read()
+
+            if play_idx >= num_dly_chunks:
+                delay_gestures = False
+
+        self.sink.drain()
+        # The song ended on its own: seeks from here on are for the next song, see Performance.seek
+        if self.play_thread is None or self.play_thread is threading.current_thread():
+            self.is_playing = False
@@ -0,0 +1,285 @@
+"""
+Author: Raghavasimhan Sankaranarayanan
+Date created: 03/03/24
+"""
+
+import json
+import os
+import time
+import wave
+import threading
+from definitions import OUTPUT_AUDIO_DEVICE, AUDIO_DEVICE_CACHE_PATH
+from ringBuffer import RingBuffer
+
+
+class AudioSink:
+    """
+    Destination for the encoded chunks AudioProcessor produces.
+    frames_written is the sink's clock: for sinks that are not realtime it is the only clock, so the pipeline runs as
+    fast as the CPU allows while timing still follows the audio.
+    underruns counts the times the device ran out of audio to play.
+    """
+    realtime = False
+
+    def __init__(self):
+        self.fs = 0
+        self.channels = 0
+        self.sampwidth = 2
+        self.frames_written = 0
+        self.underruns = 0
+        self.active = False
+
+    @property
+    def time_sec(self):
+        return self.frames_written / self.fs if self.fs else 0
+
+    def open(self, fs: int, chunk_size: int, channels: int, sampwidth: int, dtype):
+        self.fs = fs
+        self.channels = channels
+        self.sampwidth = sampwidth
+        self.frames_written = 0
+        self.active = True
+
+    def write(self, data) -> bool:
+        """
+        :param data: bytes-like chunk of interleaved samples
+        :return: False if the sink can no longer be written
+        """
+        self.frames_written += len(data) // (self.channels * self.sampwidth)
+        return self.active
+
+    def drain(self):
+        """ Block until everything written has been played """
+        pass
+
+    def abort(self):
+        """ Make pending and future writes return immediately, e.g. when playback is stopped """
+        self.active = False
+
+    def close(self):
+        self.active = False
+
+    def terminate(self):
+        self.close()
+
+
+class NullSink(AudioSink):
+    """
+    Discards the audio. Only advances the clock
+    """
+
+
+class WavFileSink(AudioSink):
+    """
+    Writes the audio to a WAV file instead of a device
+    """
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self.wf: wave.Wave_write or None = None
+
+    def open(self, fs: int, chunk_size: int, channels: int, sampwidth: int, dtype):
+        self.close()
+        super().open(fs, chunk_size, channels, sampwidth, dtype)
+        self.wf = wave.open(self.path, "wb")
+        self.wf.setnchannels(channels)
+        self.wf.setsampwidth(sampwidth)
+        self.wf.setframerate(fs)
+
+    def write(self, data) -> bool:
+        if not self.wf:
+            return False
+        self.wf.writeframes(data)
+        return super().write(data)
+
+    def close(self):
+        super().close()
+        if self.wf:
+            self.wf.close()
+            self.wf = None
+
+
+class PyAudioSink(AudioSink):
+    """
+    Plays on the PyAudio output device, either with blocking writes or, with callback_stream, through a ring buffer
+    that the device callback copies out of.
+    pyaudio is only imported when a sink is created, so headless runs with other sinks do not need it
+    """
+    realtime = True
+
+    def __init__(self, chunk_size=256, callback_stream=False, buffer_chunks=4):
+        super().__init__()
+        import pyaudio
+        self.pyaudio = pyaudio
+        self.chunk_size = chunk_size
+
+        # PyAudio is created on first use, see the pya property
+        self._pya: pyaudio.PyAudio or None = None
+        self.stream: pyaudio.Stream or None = None
+        self.mutex = threading.Lock()
+
+        # callback mode: the play thread fills a ring buffer ahead and the device callback copies out of it
+        self.callback_stream = callback_stream
+        self.buffer_chunks = buffer_chunks
+        self.ring: RingBuffer or None = None
+        # Set by the first chunk written after open
+        self.primed = False
+
+        self.host_api = 0
+        self.output_device_id: int or None = None
+
+    @property
+    def pya(self):
+        if self._pya is None:
+            self._pya = self.pyaudio.PyAudio()
+        return self._pya
+
+    def terminate(self):
+        self.close()
+        if self._pya:
+            self._pya.terminate()
+            self._pya = None
+
+    @staticmethod
+    def device_cache_key(host_api, name):
+        return f"{host_api}:{name}"
+
+    @staticmethod
+    def load_device_cache() -> dict:
+        try:
+            with open(AUDIO_DEVICE_CACHE_PATH) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    @staticmethod
+    def save_device_cache(cache: dict):
+        try:
+            os.makedirs(os.path.dirname(AUDIO_DEVICE_CACHE_PATH), exist_ok=True)
+            with open(AUDIO_DEVICE_CACHE_PATH, "w") as f:
+                json.dump(cache, f)
+        except OSError as e:
+            print(f"Warning: Could not save audio device cache: {e}")
+
+    def config_device(self, refresh=False):
+        """
+        Resolve OUTPUT_AUDIO_DEVICE to a device id, from the on-disk cache unless refresh is set
+        :param refresh: ignore the cache and enumerate the devices of the host API
+        """
+        t = time.time()
+        key = self.device_cache_key(self.host_api, OUTPUT_AUDIO_DEVICE)
+        cache = self.load_device_cache()
+
+        if not refresh and key in cache:
+            self.output_device_id = cache[key]
+            print(f"Output device set to '{OUTPUT_AUDIO_DEVICE}' with id {self.output_device_id} (cached)")
+        else:
+            self.output_device_id = None
+            print("----------------------device list---------------------")
+            info = self.pya.get_host_api_info_by_index(self.host_api)
+            num_devices = info.get('deviceCount')
+            for i in range(num_devices):
+                dev_info = self.pya.get_device_info_by_host_api_device_index(self.host_api, i)
+                if (dev_info.get('maxOutputChannels')) > 0:
+                    name = dev_info.get('name')
+                    print(name)
+                    if name == OUTPUT_AUDIO_DEVICE:
+                        self.output_device_id = dev_info.get('index')
+                        print(f"Output device set to '{name}' with id {self.output_device_id}")
+            print("-------------------------------------------------------------")
+
+            if self.output_device_id is not None:
+                cache[key] = self.output_device_id
+                self.save_device_cache(cache)
+
+        print(f"Audio device setup took {(time.time() - t) * 1000:.1f} ms")
+
+    def stream_callback(self, in_data, frame_count, time_info, status):
+        # Running dry only counts while a producer is writing: not before the first chunk or after drain
+        producing = self.active and self.primed
+        if status & self.pyaudio.paOutputUnderflow and producing:
+            self.underruns += 1
+        data = self.ring.pop()
+        if data is None:
+            if producing:
+                self.underruns += 1
+            return self.ring.silence, self.pyaudio.paContinue
+        return data, self.pyaudio.paContinue
+
+    def open(self, fs: int, chunk_size: int, channels: int, sampwidth: int, dtype):
+        self.close()
+        super().open(fs, chunk_size, channels, sampwidth, dtype)
+        self.chunk_size = chunk_size
+        self.primed = False
+
+        kwargs = {}
+        if self.callback_stream:
+            self.ring = RingBuffer(self.buffer_chunks, chunk_size, channels, dtype=dtype)
+            kwargs["stream_callback"] = self.stream_callback
+
+        if self.output_device_id is None:
+            self.config_device()
+
+        def _open():
+            return self.pya.open(rate=fs,
+                                 channels=channels,
+                                 format=self.pya.get_format_from_width(sampwidth),
+                                 input=False, output=True,
+                                 frames_per_buffer=chunk_size,
+                                 output_device_index=self.output_device_id,
+                                 **kwargs)
+
+        try:
+            self.stream = _open()
+        except (OSError, ValueError):
+            # The cached id may point to a different or missing device. Enumerate again and retry once
+            self.config_device(refresh=True)
+            self.stream = _open()
+
+    def write(self, data) -> bool:
+        """
+        Hand one encoded chunk to the device. In callback mode this only waits while the ring buffer is full
+        :return: False if the stream can no longer be written
+        """
+        if self.callback_stream:
+            wait_sec = self.chunk_size / self.fs / 2
+            while not self.ring.push(data):
+                if not self.active:
+                    return False
+                time.sleep(wait_sec)
+            self.primed = True
+            return super().write(data)
+
+        with self.mutex:
+            if not self.stream:
+                return False
+            try:
+                self.stream.write(data, exception_on_underflow=True)
+            except OSError as e:
+                # The chunk was still written when the device reports an underflow
+                if e.args and e.args[0] == self.pyaudio.paOutputUnderflowed:
+                    self.underruns += 1
+                else:
+                    print(f"Audio write error: {e}")
+                    return False
+        return super().write(data)
+
+    def drain(self):
+        """
+        Wait for the device callback to play out whatever is left in the ring buffer
+        """
+        if not self.callback_stream or not self.ring:
+            return
+        wait_sec = self.chunk_size / self.fs / 2
+        while self.active and self.ring.available > 0:
+            time.sleep(wait_sec)
+        # The song is over, so the device callback idles on silence from here on
+        self.active = False
+
+    def close(self):
+        super().close()
+        with self.mutex:
+            if self.stream:
+                self.stream.stop_stream()
+                self.stream.close()
+                self.stream = None
@@ -0,0 +1,86 @@
+"""
+Author: Raghavasimhan Sankaranarayanan
+Date created: 03/03/24
+"""
+
+import time
+import numpy as np
+
+
+class AudioStats:
+    """
+    Per-chunk timing of the play thread, kept in preallocated ring buffers so it can stay enabled while playing.
+    - process: time spent in the callback, encoding and fading a chunk
+    - write: time the sink blocked while taking the chunk
+    - lateness: when the chunk was handed to the sink relative to when it is due (negative = ahead of time).
+      Only measured for realtime sinks
+    A chunk whose processing takes longer than its duration counts as an overrun.
+    Underruns (the device running dry) are counted by the sink.
+    """
+    # Histogram edges as fractions of the chunk duration
+    BINS = np.array([0, 0.1, 0.25, 0.5, 0.75, 1, 1.5, 2, np.inf])
+
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self.process_ms = np.zeros(capacity, dtype=np.float32)
+        self.write_ms = np.zeros(capacity, dtype=np.float32)
+        self.lateness_ms = np.zeros(capacity, dtype=np.float32)
+
+        self.chunk_ms = 0
+        self.count = 0
+        self.overruns = 0
+        self.t0 = None
+
+    def reset(self, chunk_duration_sec: float):
+        self.chunk_ms = chunk_duration_sec * 1000
+        self.count = 0
+        self.overruns = 0
+        self.t0 = None
+
+    def record(self, process_sec: float, write_sec: float, realtime=True):
+        """
+        :param process_sec: time spent producing the chunk
+        :param write_sec: time spent writing it to the sink
+        :param realtime: whether the sink plays in real time, i.e. whether lateness means anything
+        """
+        now = time.perf_counter()
+        i = self.count % self.capacity
+        self.process_ms[i] = process_sec * 1000
+        self.write_ms[i] = write_sec * 1000
+
+        if realtime:
+            if self.t0 is None:
+                self.t0 = now
+            self.lateness_ms[i] = (now - self.t0) * 1000 - self.count * self.chunk_ms
+
+        if process_sec * 1000 > self.chunk_ms:
+            self.overruns += 1
+        self.count += 1
+
+    def values(self, name: str) -> np.ndarray:
+        """
+        Recorded values of 'process', 'write' or 'lateness' still in the ring buffer
+        """
+        data = getattr(self, f"{name}_ms")
+        return data[:min(self.count, self.capacity)]
+
+    def histogram(self, name: str):
+        """
+        :return: counts and bin edges in ms
+        """
+        edges = self.BINS * self.chunk_ms
+        counts, _ = np.histogram(np.maximum(self.values(name), 0), bins=edges)
+        return counts, edges
+
+    def summary(self, underruns=0) -> str:
+        lines = [f"Audio stats: {self.count} chunks of {self.chunk_ms:.2f} ms, "
+                 f"underruns: {underruns}, overruns: {self.overruns}"]
+        for name in ("process", "write", "lateness"):
+            v = self.values(name)
+            if len(v) == 0 or (name == "lateness" and self.t0 is None):
+                continue
+            counts, edges = self.histogram(name)
+            hist = " ".join(f"<{e:.1f}:{c}" for e, c in zip(edges[1:], counts) if c)
+            lines.append(f"  {name:8s} mean {v.mean():.3f} ms, p99 {np.percentile(v, 99):.3f} ms, "
+                         f"max {v.max():.3f} ms | {hist}")
+        return "\n".join(lines)
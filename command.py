@@ -0,0 +1,21 @@
+"""
+Author: Raghavasimhan Sankaranarayanan
+Date created: 03/03/24
+"""
+
+from dataclasses import dataclass
+
+
+@dataclass
+class Command:
+    dxl_id: int = -1
+    angle: float = 0
+    start_beat: float = 0
+    duration: float = 0
+
+    @property
+    def is_valid(self):
+        return self.dxl_id >= 0 and self.duration > 0
+
+    def __repr__(self):
+        return f"id: {self.dxl_id} \t angle: {self.angle} \t start: {self.start_beat} \t period: {self.duration:.3f}sec"
@@ -3,20 +3,37 @@ Author: Raghavasimhan Sankaranarayanan
 Date created: 03/03/24
 """
 
+import os
 from enum import IntEnum, Enum
 from typing import NamedTuple
 
 SIMULATE = True
 
 OUTPUT_AUDIO_DEVICE = "default"     # "LG HDR 4K"  # "USB Audio Device"
+AUDIO_DEVICE_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "shimi", "audio_devices.json")
 
 PORT_NAME = "/dev/ttyUSB0"  # "/dev/tty.usbserial-FT62AO7Z"
 BAUD_RATE = 1000000
 ENCODER_RESOLUTION = 4096
 ACK_TIMEOUT_MS = 100
 
+SYNC_WRITE = True
+""" Send the goal position and velocity of all motors moving in a control tick as one GroupSyncWrite packet """
+
+FEEDBACK_RATE_HZ = 50
+""" Rate of the bulk read of every motor's present position. 0 disables it """
+
 UDP_PORT = 8888
 
+FADE_MS = 100
+""" Length of the fade applied on pause and resume """
+
+AUDIO_CACHE_BYTES = 256 * 1024 * 1024
+""" Memory budget for decoded song audio kept in AudioCache """
+
+LYRIC_LOOKAHEAD = 2
+""" Number of future lyric lines sent along with each line """
+
 PACE_THRESHOLD = 0.5
 """ Segments with > PACE_THRESHOLD will be classified as Normal pace """
 
@@ -63,3 +80,32 @@ class Genre(Enum):
 class Pace(IntEnum):
     SLOW = 0
     NORMAL = 1
+
+
+class FilterType(IntEnum):
+    LOW_PASS = 0
+    HIGH_PASS = 1
+    BAND_PASS = 2
+    NOTCH = 3
+    PEAK = 4
+    LOW_SHELF = 5
+    HIGH_SHELF = 6
+
+
+class FilterSpec(NamedTuple):
+    filter_type: FilterType
+    fc: float
+    Q: float = 0.707
+    gain: float = 1
+
+
+HAPTIC_GAIN = 1.25
+
+HAPTIC_FILTERS = {genre: [FilterSpec(FilterType.LOW_PASS, 100)] for genre in Genre}
+"""
+Biquad cascade applied to the haptic (right) channel, per genre. Every genre uses the original 100 Hz low pass.
+A genre can be tuned by adding sections, e.g. a bass boost under a notch on mains hum:
+    HAPTIC_FILTERS[Genre.EDM] = [FilterSpec(FilterType.LOW_PASS, 100),
+                                 FilterSpec(FilterType.LOW_SHELF, 60, gain=4),
+                                 FilterSpec(FilterType.NOTCH, 50, Q=2)]
+"""
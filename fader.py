@@ -0,0 +1,78 @@
+"""
+Author: Raghavasimhan Sankaranarayanan
+Date created: 03/03/24
+"""
+
+import math
+from enum import IntEnum
+import numpy as np
+
+
+class FadeState(IntEnum):
+    IDLE = 0
+    FADE_IN = 1
+    FADE_OUT = 2
+
+
+class Fader:
+    """
+    Applies precomputed gain ramps to the encoded chunks that follow a pause or resume.
+    Ramps are built once per stream for its chunk size, so each faded chunk costs one multiply regardless of the
+    fade length.
+    """
+    def __init__(self, chunk_size: int, channels: int, dtype, fade_ms: float, fs: int):
+        self.chunk_size = chunk_size
+        self.channels = channels
+        self.dtype = np.dtype(dtype)
+        self.num_chunks = max(1, int(math.ceil(fade_ms / 1000.0 * fs / chunk_size)))
+
+        n = self.num_chunks * chunk_size
+        ramp = (np.arange(1, n + 1, dtype=np.float32) / n).reshape((self.num_chunks, chunk_size, 1))
+        self.ramps = {FadeState.FADE_IN: ramp, FadeState.FADE_OUT: 1 - ramp}
+
+        self.work = np.zeros((chunk_size, channels), dtype=np.float32)
+        self.out = np.zeros((chunk_size, channels), dtype=self.dtype)
+        self.out_bytes = memoryview(self.out).cast('B').toreadonly()
+
+        self.state = FadeState.IDLE
+        self.idx = 0
+
+    def matches(self, chunk_size: int, channels: int, dtype, fade_ms: float, fs: int):
+        return (chunk_size, channels, np.dtype(dtype)) == (self.chunk_size, self.channels, self.dtype) and \
+            self.num_chunks == max(1, int(math.ceil(fade_ms / 1000.0 * fs / chunk_size)))
+
+    @property
+    def fading_out(self):
+        return self.state == FadeState.FADE_OUT
+
+    def start(self, fade_in: bool):
+        """
+        Start a fade. If the opposite fade is still running, continue from its current gain
+        """
+        state = FadeState.FADE_IN if fade_in else FadeState.FADE_OUT
+        if self.state == state:
+            return
+        self.idx = self.num_chunks - self.idx if self.state != FadeState.IDLE else 0
+        self.state = state
+
+    def reset(self):
+        self.state = FadeState.IDLE
+        self.idx = 0
+
+    def apply(self, data):
+        """
+        :param data: encoded chunk (bytes-like)
+        :return: data unchanged when not fading, otherwise a read-only byte view of the faded chunk
+        """
+        if self.state == FadeState.IDLE:
+            return data
+
+        samples = np.frombuffer(data, dtype=self.dtype).reshape((-1, self.channels))
+        n = len(samples)
+        np.multiply(samples, self.ramps[self.state][self.idx, :n], out=self.work[:n])
+        np.copyto(self.out[:n], self.work[:n], casting='unsafe')
+
+        self.idx += 1
+        if self.idx >= self.num_chunks:
+            self.reset()
+        return self.out_bytes if n == self.chunk_size else self.out_bytes[:n * self.channels * self.dtype.itemsize]
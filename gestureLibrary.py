@@ -0,0 +1,295 @@
+"""
+Author: Raghavasimhan Sankaranarayanan
+Date created: 03/03/24
+"""
+
+import hashlib
+import os
+import random
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, List, NamedTuple, Sequence, Tuple
+import numpy as np
+from definitions import *
+from exceptions import *
+
+GESTURE_DTYPE = np.dtype([("dxl_id", np.int32),
+                          ("angle", np.float64),
+                          ("start_beat", np.float64),
+                          ("duration", np.float64)])
+""" One gesture command. dxl_id is zero based, start_beat and duration are in beats """
+
+
+class GestureTimeline(NamedTuple):
+    """
+    Composed gestures compiled for playback, sorted by frame. The arrays are read-only, so a timeline can be
+    replayed and seeked any number of times
+    """
+    frames: np.ndarray
+    """ start of every command as an absolute sample index """
+    start_beat: np.ndarray
+    dxl_id: np.ndarray
+    angle: np.ndarray
+    duration: np.ndarray
+    """ in seconds """
+
+    def __len__(self):
+        return len(self.frames)
+
+    def range(self, start_frame: int, end_frame: int) -> Tuple[int, int]:
+        """
+        Indices [lo, hi) of the commands with start_frame <= frame < end_frame
+        """
+        lo, hi = np.searchsorted(self.frames, (start_frame, end_frame), side='left')
+        return int(lo), int(hi)
+
+    @staticmethod
+    def compile(gestures: np.ndarray, tempo: float, fs: int) -> "GestureTimeline":
+        """
+        :param gestures: composed GESTURE_DTYPE commands, in beats
+        :param tempo: in bpm
+        :param fs: sample rate the frames refer to
+        """
+        sec_per_beat = 60.0 / tempo
+        order = np.argsort(gestures["start_beat"], kind='stable')
+        g = gestures[order]
+        timeline = GestureTimeline(frames=np.round(g["start_beat"] * sec_per_beat * fs).astype(np.int64),
+                                   start_beat=g["start_beat"].copy(),
+                                   dxl_id=g["dxl_id"].copy(),
+                                   angle=g["angle"].copy(),
+                                   duration=g["duration"] * sec_per_beat)
+        for a in timeline:
+            a.flags.writeable = False
+        return timeline
+
+
+class GestureLibrary:
+    """
+    Gestures under <root>/<genre>/<pace>_<genre>_<no>.csv, each a structured array of GESTURE_DTYPE sorted by start.
+    Every genre is compiled once into <root>/.cache/<genre>.npz, which is rebuilt when a file is added, removed or
+    modified. Genres are only loaded on first use, so construction does not depend on the size of the library.
+    Seeded compositions are memoized per (song, genre, tempo, segments, seed, library version).
+    """
+    CACHE_DIR = ".cache"
+    VERSION = 1
+    MAX_COMPOSITIONS = 64
+
+    def __init__(self, root: str):
+        self.root = root
+        self.cache_path = os.path.join(root, GestureLibrary.CACHE_DIR)
+        self.genres: Dict[Genre, Dict[Pace, List[np.ndarray]]] = {}
+        self.versions: Dict[Genre, str] = {}
+        self.lock = threading.Lock()
+
+        self.compositions: OrderedDict[tuple, np.ndarray] = OrderedDict()
+        self.composition_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return f"GestureLibrary: {len(self.genres)} genres loaded, {len(self.compositions)} compositions, " \
+               f"hits: {self.hits}, misses: {self.misses}"
+
+    def __getitem__(self, genre: Genre) -> Dict[Pace, List[np.ndarray]]:
+        """
+        :return: gestures of genre by pace
+        """
+        with self.lock:
+            gestures = self.genres.get(genre)
+            if gestures is None:
+                gestures = self.load(genre)
+                self.genres[genre] = gestures
+            return gestures
+
+    def version(self, genre: Genre) -> str:
+        """
+        Short hash of the gesture files of genre, which changes whenever one of them does
+        """
+        self[genre]     # loads the genre and its version
+        return self.versions[genre]
+
+    def __contains__(self, genre: Genre):
+        return genre in self.genres or os.path.isdir(os.path.join(self.root, genre.value))
+
+    @staticmethod
+    def read_csv(path: str) -> np.ndarray:
+        # DS: [motor id (1 based), start beat absolute, position (0, 1), length in beats]
+        raw_data = np.loadtxt(path, delimiter=',', ndmin=2)
+
+        # Sort gestures in terms of their start times
+        raw_data = raw_data[raw_data[:, 1].argsort(kind='stable')]
+
+        g = np.empty(len(raw_data), dtype=GESTURE_DTYPE)
+        g["dxl_id"] = raw_data[:, 0].astype(np.int32) - 1
+        g["start_beat"] = raw_data[:, 1]
+        g["angle"] = raw_data[:, 2]
+        g["duration"] = raw_data[:, 3]
+        return g
+
+    def scan(self, genre: Genre):
+        """
+        :return: sorted csv names of genre and their modification times
+        """
+        path = os.path.join(self.root, genre.value)
+        names, mtimes = [], []
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.name.endswith(".csv"):
+                    names.append(entry.name)
+                    mtimes.append(entry.stat().st_mtime_ns)
+        order = np.argsort(names)
+        return np.array(names, dtype=str)[order], np.array(mtimes, dtype=np.int64)[order]
+
+    def compile(self, genre: Genre, names: np.ndarray, mtimes: np.ndarray) -> dict:
+        """
+        Parse every csv of genre into one table: gesture k spans data[offsets[k]:offsets[k + 1]]
+        """
+        path = os.path.join(self.root, genre.value)
+        gestures, paces = [], []
+        for f in names:
+            pace, _, _ = os.path.splitext(f)[0].split('_')
+            if int(pace) not in (Pace.SLOW, Pace.NORMAL):
+                raise NotInRangeException
+            gestures.append(self.read_csv(os.path.join(path, f)))
+            paces.append(int(pace))
+
+        offsets = np.zeros(len(gestures) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(g) for g in gestures])
+        data = np.concatenate(gestures) if gestures else np.zeros(0, dtype=GESTURE_DTYPE)
+        return {"version": np.array(GestureLibrary.VERSION), "names": names, "mtimes": mtimes,
+                "data": data, "offsets": offsets, "paces": np.array(paces, dtype=np.int8)}
+
+    def load(self, genre: Genre) -> Dict[Pace, List[np.ndarray]]:
+        """
+        Load the compiled genre, compiling it again if it is missing or out of date
+        """
+        names, mtimes = self.scan(genre)
+        path = os.path.join(self.cache_path, genre.value + ".npz")
+
+        compiled = None
+        try:
+            with np.load(path, allow_pickle=False) as f:
+                if int(f["version"]) == GestureLibrary.VERSION and np.array_equal(f["names"], names) and \
+                        np.array_equal(f["mtimes"], mtimes):
+                    compiled = {k: f[k] for k in f.files}
+        except (OSError, ValueError, KeyError):
+            pass
+
+        if compiled is None:
+            compiled = self.compile(genre, names, mtimes)
+            self.save(path, compiled)
+
+        self.versions[genre] = hashlib.md5(names.tobytes() + mtimes.tobytes()).hexdigest()[:8]
+        data, offsets, paces = compiled["data"], compiled["offsets"], compiled["paces"]
+        data.flags.writeable = False
+        gestures = {Pace.SLOW: [], Pace.NORMAL: []}
+        for k, pace in enumerate(paces):
+            gestures[Pace(int(pace))].append(data[offsets[k]:offsets[k + 1]])
+        return gestures
+
+    @staticmethod
+    def save(path: str, compiled: dict):
+        tmp = path + ".tmp.npz"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            np.savez(tmp, **compiled)
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"Warning: Could not save gesture cache {path}: {e}")
+
+    def compose(self, genre: Genre, tempo: float, segments: Sequence[Tuple[float, float]], seed: int = None,
+                song_id: str = None) -> np.ndarray:
+        """
+        Compose the gestures of a song with random.Random(seed). The same seed always gives the same composition.
+        When both seed and song_id are given, the result is memoized and reused by later calls.
+        :param tempo: in bpm
+        :param segments: (start in sec, pace) of every segment
+        :param seed: None draws a fresh composition every time
+        :param song_id: id of the song being composed, for the memo
+        :return: read-only GESTURE_DTYPE commands of the whole song with start_beat in absolute beats
+        """
+        key = None
+        if seed is not None and song_id is not None:
+            key = (song_id, genre, tempo, tuple(tuple(s) for s in segments), seed, self.version(genre))
+            with self.composition_lock:
+                gestures = self.compositions.get(key)
+                if gestures is not None:
+                    self.compositions.move_to_end(key)
+                    self.hits += 1
+                    return gestures
+                self.misses += 1
+
+        gestures = self.compose_random(genre, tempo, segments, random.Random(seed))
+        gestures.flags.writeable = False
+
+        if key is not None:
+            with self.composition_lock:
+                self.compositions[key] = gestures
+                while len(self.compositions) > GestureLibrary.MAX_COMPOSITIONS:
+                    self.compositions.popitem(last=False)
+        return gestures
+
+    def warm(self, songs: Iterable[Tuple[str, Genre, float, Sequence[Tuple[float, float]]]],
+             seed: int) -> threading.Thread:
+        """
+        Compose every song on a background thread so later calls to compose for them are memo hits
+        :param songs: (song id, genre, tempo, segments) of every song
+        """
+        def handler():
+            for song_id, genre, tempo, segments in songs:
+                try:
+                    self.compose(genre, tempo, segments, seed=seed, song_id=song_id)
+                except Exception as e:
+                    print(f"Warning: Could not compose gestures for {song_id}: {e}")
+
+        thread = threading.Thread(target=handler, daemon=True)
+        thread.start()
+        return thread
+
+    def compose_random(self, genre: Genre, tempo: float, segments: Sequence[Tuple[float, float]],
+                       rng: random.Random) -> np.ndarray:
+        """
+        Fill every segment but the last with a randomly chosen gesture of its pace (never the same one twice in a
+        row), looped as many whole times as it fits and then cut to the rounded remaining beats.
+        Whole loops are tiled and shifted in one broadcast, and the cut keeps the commands whose running sum of
+        start + duration stays within the remainder.
+        :param tempo: in bpm
+        :param segments: (start in sec, pace) of every segment
+        :param rng: source of the gesture choices
+        :return: GESTURE_DTYPE commands of the whole song with start_beat in absolute beats
+        """
+        library = self[genre]
+        parts = []
+        offset = 0
+        last_idx = -1
+
+        for i in range(1, len(segments)):
+            # left and right boundaries in beats
+            seg_len = (segments[i][0] - segments[i - 1][0]) * tempo / 60.0
+
+            pace = Pace.NORMAL if segments[i - 1][1] > PACE_THRESHOLD else Pace.SLOW
+            gestures = library[pace]
+
+            # choose a random index (non-repeating) for gesture
+            idx = rng.choice([ii for ii in range(len(gestures)) if ii != last_idx])
+            last_idx = idx
+
+            g = gestures[idx]
+            g_dur = g["start_beat"][-1] + g["duration"][-1]
+            num_loops = int(seg_len // g_dur)
+            residual_dur = round(seg_len - num_loops * g_dur)
+
+            loops = np.tile(g, num_loops)
+            loops["start_beat"] += np.repeat(offset + np.arange(num_loops) * g_dur, len(g))
+            offset += num_loops * g_dur
+
+            cut = g[np.cumsum(g["start_beat"] + g["duration"]) <= residual_dur].copy()
+            cut["start_beat"] += offset
+            offset += residual_dur
+
+            parts.extend((loops, cut))
+
+        song_gesture = np.concatenate(parts) if parts else np.zeros(0, dtype=GESTURE_DTYPE)
+        # Adjust for feels
+        song_gesture["start_beat"] += 0.25
+        return song_gesture
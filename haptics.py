@@ -0,0 +1,87 @@
+"""
+Author: Raghavasimhan Sankaranarayanan
+Date created: 03/03/24
+"""
+
+import hashlib
+import os
+from typing import Callable, List
+import numpy as np
+from definitions import *
+from util import FilterBank
+from wavSource import WavSource
+from resampler import Resampler
+
+
+class HapticRenderer:
+    """
+    Renders the whole haptic stereo mix of a song in one pass:
+    mono sum on the left channel, the mono sum through the genre's filter bank times HAPTIC_GAIN on the right.
+    The result can be persisted as a sidecar .npy next to the song's .wav.
+    """
+    def __init__(self, fs: int, filters: List[FilterSpec], gain=HAPTIC_GAIN):
+        self.fs = fs
+        self.filters = filters
+        self.gain = gain
+
+    @property
+    def config_hash(self):
+        """ Short hash of everything that affects the rendered track """
+        config = repr((self.fs, [tuple(f) for f in self.filters], self.gain))
+        return hashlib.md5(config.encode()).hexdigest()[:8]
+
+    def sidecar_path(self, audio_path: str):
+        return f"{os.path.splitext(audio_path)[0]}.haptic-{self.config_hash}.npy"
+
+    def render(self, data: np.ndarray) -> np.ndarray:
+        """
+        :param data: int16 samples with shape (num_frames, channels) at self.fs
+        :return: int16 haptic mix with shape (num_frames, 2)
+        """
+        scale = 2 ** (8 * data.dtype.itemsize - 1)
+        audio = np.mean(data, axis=1, dtype=np.float32) / scale
+
+        out = np.empty((len(audio), 2), dtype=np.float32)
+        out[:, 0] = audio
+        out[:, 1] = FilterBank(self.filters, self.fs).process(audio) * self.gain
+
+        out *= scale
+        np.clip(out, -scale, scale - 1, out=out)
+        return out.astype(data.dtype)
+
+    def num_frames(self, audio_path: str) -> int:
+        """
+        Length of the haptic track of audio_path at self.fs, from its header alone
+        """
+        src = WavSource(audio_path)
+        up, down = Resampler.ratio(src.fs, self.fs)
+        return -(-src.num_frames * up // down)
+
+    def load_or_render(self, audio_path: str, load: Callable[[], np.ndarray], persist=True) -> np.ndarray:
+        """
+        Load the sidecar if it is newer than the song's audio, otherwise render it and optionally save it.
+        The sidecar is validated against the header of the .wav, so the audio is only decoded when it has to be rendered
+        :param audio_path: path of the source .wav
+        :param load: returns the decoded source audio at self.fs. Only called on a miss
+        :param persist: whether to write the sidecar
+        """
+        path = self.sidecar_path(audio_path)
+        if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(audio_path):
+            try:
+                track = np.load(path, mmap_mode='r')
+                if track.shape == (self.num_frames(audio_path), 2):
+                    return track
+            except (OSError, ValueError):
+                pass
+
+        track = self.render(load())
+        if persist:
+            tmp = path + ".tmp"
+            try:
+                with open(tmp, "wb") as f:
+                    np.save(f, track)
+                os.replace(tmp, path)
+            except OSError as e:
+                print(f"Warning: Could not save haptic track {path}: {e}")
+        track.flags.writeable = False
+        return track
@@ -0,0 +1,141 @@
+"""
+Author: Raghavasimhan Sankaranarayanan
+Date created: 03/03/24
+"""
+
+import re
+from typing import Iterable, List, NamedTuple
+import numpy as np
+
+
+class Lyrics(NamedTuple):
+    times: np.ndarray
+    """ time stamp of every line in seconds, sorted """
+    text_table: List[str]
+    """ unique line texts """
+    text_idx: np.ndarray
+    """ index into text_table for every line """
+    tags: dict
+    """ id tags such as ar, al, ti, length and offset """
+
+
+class LrcParser:
+    """
+    Minimal streaming LRC parser. Reads only what the performance needs (time and text of each line) straight into
+    arrays. Lines may carry several time stamps ([00:12.00][00:45.00]text), and [offset:] is applied so that a
+    positive value makes the lyrics appear sooner. The LRC format gives the offset in milliseconds, but the song
+    library writes it in seconds ([offset:-2.54]), so a value with a decimal point is read as seconds and an integer
+    one as milliseconds.
+    """
+    TIMESTAMP = re.compile(r"\[(\d+):(\d+(?:\.\d*)?)\]")
+    TAG = re.compile(r"\[([a-zA-Z#]+):(.*)\]\s*$")
+
+    @staticmethod
+    def parse(lines: Iterable[str]) -> Lyrics:
+        times: List[float] = []
+        text_idx: List[int] = []
+        table = {}
+        tags = {}
+
+        for line in lines:
+            line = line.rstrip("\r\n")
+            if not line.startswith("["):
+                continue
+
+            pos = 0
+            stamps = []
+            match = LrcParser.TIMESTAMP.match(line, pos)
+            while match:
+                stamps.append(int(match.group(1)) * 60 + float(match.group(2)))
+                pos = match.end()
+                match = LrcParser.TIMESTAMP.match(line, pos)
+
+            if stamps:
+                idx = table.setdefault(line[pos:], len(table))
+                times.extend(stamps)
+                text_idx.extend([idx] * len(stamps))
+                continue
+
+            match = LrcParser.TAG.match(line)
+            if match:
+                tags[match.group(1).lower()] = match.group(2).strip()
+
+        times = np.asarray(times, dtype=np.float64)
+        text_idx = np.asarray(text_idx, dtype=np.int32)
+
+        offset = LrcParser.offset_sec(tags)
+        if offset:
+            times -= offset
+
+        order = np.argsort(times, kind='stable')
+        return Lyrics(times[order], list(table), text_idx[order], tags)
+
+    @staticmethod
+    def offset_sec(tags: dict) -> float:
+        """
+        :return: the [offset:] tag in seconds, 0 if it is missing or malformed
+        """
+        value = tags.get("offset", "0")
+        try:
+            return float(value) if "." in value else int(value) / 1000.0
+        except ValueError:
+            return 0.0
+
+    @staticmethod
+    def parse_file(path: str) -> Lyrics:
+        with open(path, encoding="utf-8") as f:
+            return LrcParser.parse(f)
+
+
+if __name__ == "__main__":
+    # Benchmark against pylrc over every .lrc in the song library
+    import os
+    import sys
+    import time
+    import pylrc
+
+    root = sys.argv[1] if len(sys.argv) > 1 else "songs"
+    repeats = 20
+    paths = [os.path.join(d, f) for d, _, files in os.walk(root) for f in sorted(files) if f.endswith(".lrc")]
+    contents = []
+    for p in paths:
+        with open(p, encoding="utf-8") as f:
+            contents.append(f.read())
+
+    t = time.perf_counter()
+    for _ in range(repeats):
+        for c in contents:
+            pylrc.parse(c)
+    t_pylrc = (time.perf_counter() - t) / repeats
+
+    t = time.perf_counter()
+    for _ in range(repeats):
+        for p in paths:
+            LrcParser.parse_file(p)
+    t_native = (time.perf_counter() - t) / repeats
+
+    # pylrc ignores [offset:], so every line should differ from it by exactly the offset we apply
+    mismatches = 0
+    shifted = 0
+    for p, c in zip(paths, contents):
+        ref = pylrc.parse(c)
+        lrc = LrcParser.parse_file(p)
+        text = [lrc.text_table[i] for i in lrc.text_idx]
+        offset = LrcParser.offset_sec(lrc.tags)
+        if len(ref) != len(lrc.times) or [l.text for l in ref] != text:
+            mismatches += 1
+            print(f"Mismatch: {p}")
+            continue
+        shift = lrc.times - np.array([l.time for l in ref], dtype=np.float64)
+        if not np.allclose(shift, -offset, atol=1e-3):
+            mismatches += 1
+            print(f"Mismatch: {p} (shifted {shift.min():+.3f}..{shift.max():+.3f} sec, offset {-offset:+.3f} sec)")
+        elif offset:
+            shifted += 1
+            print(f"Offset: {p} [offset:{lrc.tags['offset']}] -> lines {-offset:+.3f} sec vs pylrc")
+
+    print(f"{len(paths)} files, {sum(len(c) for c in contents) / 1024:.1f} KB")
+    print(f"pylrc (from memory): {t_pylrc * 1000:.2f} ms")
+    print(f"native (from disk):  {t_native * 1000:.2f} ms ({t_pylrc / t_native:.1f}x)")
+    print(f"offset applied: {shifted} files")
+    print(f"mismatches: {mismatches}")
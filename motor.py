@@ -11,6 +11,8 @@ import numpy as np
 from definitions import *
 from exceptions import *
 import time
+from threading import Lock
+from typing import Optional
 
 
 class Motor:
@@ -18,7 +20,12 @@ class Motor:
                  motion_limit: LIMIT,
                  encoder_resolution: int = ENCODER_RESOLUTION,
                  moving_threshold: int = 20,
-                 cmd_rate_ms: int = 50):
+                 cmd_rate_ms: int = 50,
+                 bus_lock: Lock = None):
+        """
+        :param bus_lock: lock shared by everything that talks on the port, including Shimi's group sync write and
+        bulk read, whose tables are only touched while holding it
+        """
         self.port = port_handler
         self.id = dxl_id
         self.packet_handler = dxl.PacketHandler(protocol_version=1)
@@ -30,8 +37,26 @@ class Motor:
         self.byte_length = {1, 2, 4}
         self.byte_map = PARAM_BYTE_LENGTH_MAP()
 
+        self.bus_lock = bus_lock or Lock()
+
         self.last_cmd_time = time.time() - 10
-        self.current_position = 0
+        self.goal_position = 0
+
+        # Present positions of all motors, kept up to date by Shimi's bulk read. Negative until known
+        self.feedback: Optional[np.ndarray] = None
+
+    @property
+    def current_position(self):
+        """
+        Present position from the feedback when there is any, otherwise the last commanded one
+        """
+        if self.feedback is not None and self.feedback[self.id] >= 0:
+            return int(self.feedback[self.id])
+        return self.goal_position
+
+    @current_position.setter
+    def current_position(self, position: int):
+        self.goal_position = position
 
     def __del__(self):
         self.reset()
@@ -42,12 +67,16 @@ class Motor:
     def in_range(self, value):
         return self.LIMIT.MIN <= value <= self.LIMIT.MAX
 
-    def enable(self, enable=True, wait=False):
+    def enable(self, enable=True, wait=False, home=True):
+        """
+        :param home: move to the initial position after enabling. Shimi homes all motors at once instead
+        """
         self.write(ADDR.TORQUE_ENABLE, 1 if enable else 0, 1)
 
         if enable:
             self.current_position = self.read_position()
-            self.move_to_position(INITIAL_POSITIONS[self.id], 1, wait=wait)
+            if home:
+                self.move_to_position(INITIAL_POSITIONS[self.id], 1, wait=wait)
 
     def reset_position(self, wait=False):
         try:
@@ -63,14 +92,15 @@ class Motor:
         :param is_percent: whether the value is angle or percent
         :return: None
         """
-        # No need to check angle limit here since we check position limits before writing
-        ticks = self.percent2ticks(value) if is_percent else self.angle2ticks(value, is_radian=True)
-
         try:
-            self.move_to_position(ticks, duration)
+            self.move_to_position(self.target_ticks(value, is_percent), duration)
         except FastCommandException:
             print("Fast command!")
 
+    def target_ticks(self, value: float, is_percent=False) -> int:
+        # No need to check angle limit here since we check position limits before writing
+        return self.percent2ticks(value) if is_percent else self.angle2ticks(value, is_radian=True)
+
     def ticks2angle(self, ticks: int):
         return (ticks * 1.0 / self.ENCODER_RESOLUTION) * (2 * math.pi)
 
@@ -87,7 +117,11 @@ class Motor:
         rpm = velocity * 60 / (2 * math.pi)
         return int(round(rpm / 0.114))  # refer: https://emanual.robotis.com/docs/en/dxl/mx/mx-28/#moving-speed
 
-    def move_to_position(self, position: int, duration: float, wait=False):
+    def plan_move(self, position: int, duration: float) -> int:
+        """
+        Check that a move can be sent now
+        :return: goal velocity for it in rpm ticks
+        """
         if not self.in_range(position):
             raise NotInRangeException
 
@@ -99,6 +133,25 @@ class Motor:
         if rpm_ticks >= 1024:
             print(f"rpm too high: {rpm_ticks}")
             rpm_ticks = min(rpm_ticks, 1023)
+        return rpm_ticks
+
+    def moved(self, position: int):
+        """
+        Record a move that was written to the motor
+        """
+        self.last_cmd_time = time.time()
+        self.goal_position = position
+
+    @staticmethod
+    def goal_params(position: int, rpm_ticks: int):
+        """
+        Goal position and velocity as the bytes of the consecutive registers from ADDR.GOAL_POSITION, for a sync write
+        """
+        return [dxl.DXL_LOBYTE(position), dxl.DXL_HIBYTE(position),
+                dxl.DXL_LOBYTE(rpm_ticks), dxl.DXL_HIBYTE(rpm_ticks)]
+
+    def move_to_position(self, position: int, duration: float, wait=False):
+        rpm_ticks = self.plan_move(position, duration)
 
         # print(f"id: {self.id}, pos: {position}, dur: {duration}, rpm: {rpm_ticks}")
         try:
@@ -107,21 +160,22 @@ class Motor:
                        position,
                        size=self.byte_map.POSITION,
                        read_addr=ADDR.PRESENT_POSITION if wait else None)
-
-            self.last_cmd_time = time.time()
-            self.current_position = position
+            self.moved(position)
         except DxlCommError:
             print("Dynamixel Communication Error")
 
     def read_position(self):
         pos = self.read(ADDR.PRESENT_POSITION, size=self.byte_map.POSITION)
         self.current_position = pos
+        if self.feedback is not None:
+            self.feedback[self.id] = pos
         return pos
 
     def read(self, addr: int, size: int):
-        value = self.current_position
+        value = self.goal_position
         if not SIMULATE:
-            value, res, err = self.packet_handler.read2ByteTxRx(self.port, self.id + 1, addr)
+            with self.bus_lock:
+                value, res, err = self.packet_handler.read2ByteTxRx(self.port, self.id + 1, addr)
             if res != dxl.COMM_SUCCESS or err != 0:
                 print(res, err)
                 raise DxlCommError
@@ -135,27 +189,38 @@ class Motor:
             err = 0
             res = dxl.COMM_SUCCESS
 
-            if size == 1:
-                res, err = self.packet_handler.write1ByteTxRx(self.port, self.id + 1, write_addr, data)
-            elif size == 2:
-                res, err = self.packet_handler.write2ByteTxRx(self.port, self.id + 1, write_addr, data)
-            elif size == 4:
-                res, err = self.packet_handler.write4ByteTxRx(self.port, self.id + 1, write_addr, data)
+            with self.bus_lock:
+                if size == 1:
+                    res, err = self.packet_handler.write1ByteTxRx(self.port, self.id + 1, write_addr, data)
+                elif size == 2:
+                    res, err = self.packet_handler.write2ByteTxRx(self.port, self.id + 1, write_addr, data)
+                elif size == 4:
+                    res, err = self.packet_handler.write4ByteTxRx(self.port, self.id + 1, write_addr, data)
 
             if res != dxl.COMM_SUCCESS or err != 0:
                 raise DxlCommError
 
             if read_addr is not None:
-                t = time.time()
-                timeout = float("inf") if ACK_TIMEOUT_MS <= 0 else ACK_TIMEOUT_MS / 1000.0
-
-                while time.time() - t < timeout:
-                    ret_data, res, err = self.packet_handler.readTxRx(self.port, self.id, read_addr, size)
-                    if res != dxl.COMM_SUCCESS or err != 0:
-                        raise DxlCommError
-
-                    if abs(data - ret_data[0]) < self.MOVING_THRESHOLD:
-                        break
+                self.wait_for(data, read_addr, size)
 
         else:
             time.sleep(0.005)
+
+    def wait_for(self, data: int, read_addr: int = ADDR.PRESENT_POSITION, size: int = 2):
+        """
+        Poll read_addr until it is within MOVING_THRESHOLD of data or ACK_TIMEOUT_MS passes.
+        Present position is taken from the feedback when there is any instead of reading the motor
+        """
+        if SIMULATE:
+            return
+
+        use_feedback = read_addr == ADDR.PRESENT_POSITION and self.feedback is not None
+        t = time.time()
+        timeout = float("inf") if ACK_TIMEOUT_MS <= 0 else ACK_TIMEOUT_MS / 1000.0
+
+        while time.time() - t < timeout:
+            value = self.current_position if use_feedback else self.read(read_addr, size)
+            if abs(data - value) < self.MOVING_THRESHOLD:
+                break
+            if use_feedback:
+                time.sleep(0.001)
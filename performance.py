@@ -3,233 +3,344 @@ Author: Raghavasimhan Sankaranarayanan
 Date created: 03/03/24
 """
 
-import random
+import queue
+from threading import Thread
 
 import numpy as np
-import os
 import signal
-from shimi import Shimi, Command
+from command import Command
 from definitions import *
 from audioProcessor import AudioProcessor
+from audioCache import AudioCache
+from audioSink import AudioSink, NullSink
 from networkHandler import NetworkCommand, NetworkHandler, Packet
-from util import Util
+from haptics import HapticRenderer
+from wavSource import WavSource
 from song import Song
+from songLibrary import SongLibrary
+from gestureLibrary import GestureLibrary, GestureTimeline, GESTURE_DTYPE
+from prerender import PrerenderStore
 from typing import List, Tuple, Optional
 from copy import copy
 from exceptions import *
 
 
 class Performance:
-    def __init__(self, song_library_path: str, gesture_library_path: str, chunk_size=256, sample_rate=44100):
+    def __init__(self, song_library_path: str, gesture_library_path: str, chunk_size=256, sample_rate=44100,
+                 callback_stream=False, buffer_chunks=4, persist_haptics=True,
+                 headless=False, sink: AudioSink = None, gesture_seed: int = 0, prerender_path: str = None):
+        """
+        :param headless: run without motors, network and audio device. Audio goes to sink (a NullSink by default)
+        as fast as the CPU allows, and lyric and gesture dispatch is recorded in self.timeline instead
+        :param gesture_seed: seed of the gesture composition. Each song is composed the same way every time it is
+        played, and the compositions of the whole library are warmed in the background on start. None composes anew
+        on every play
+        :param prerender_path: store written by prerender.py. Songs found there up to date are loaded instead of
+        being rendered and composed on START
+        """
         self.song_lib_path = song_library_path
         self.gesture_lib_path = gesture_library_path
         self.chunk_size = chunk_size
         self.fs = sample_rate
+        self.headless = headless
 
-        self.gesture_library = {}
-        self.gestures = []
-        self.load_gesture_library()
+        self.persist_haptics = persist_haptics
+        self.haptic_track: Optional[np.ndarray] = None
 
+        self.song_library = SongLibrary(song_library_path)
+
+        self.gesture_library = GestureLibrary(gesture_library_path)
+        self.gesture_seed = gesture_seed
+
+        self.prerendered: Optional[PrerenderStore] = None
+        if prerender_path and gesture_seed is not None:
+            self.prerendered = PrerenderStore(prerender_path, sample_rate, gesture_seed)
+        self.gestures = GestureTimeline.compile(np.zeros(0, dtype=GESTURE_DTYPE), 120, sample_rate)
+
+        # (time in sec, event type, payload) of every lyric and gesture dispatched
+        self.timeline: List[Tuple[float, str, object]] = []
+
+        if headless and not sink:
+            sink = NullSink()
+
+        self.audio_cache = AudioCache()
         self.audio_processor = AudioProcessor(chunk_size=self.chunk_size,
                                               sample_rate=sample_rate,
                                               audio_callback=self.callback,
-                                              complete_callback=self.song_complete_callback)
-        self.shimi = Shimi(LIMITS)
-        self.udp = NetworkHandler(UDP_PORT, self.network_callback, timeout_sec=0.25)
-        self.gesture_idx = 0
-        self.play_idx = 0
+                                              complete_callback=self.song_complete_callback,
+                                              callback_stream=callback_stream,
+                                              buffer_chunks=buffer_chunks,
+                                              audio_cache=self.audio_cache,
+                                              decode_chunks=False,
+                                              sink=sink)
+        self.shimi = None
+        self.udp: Optional[NetworkHandler] = None
+        if not headless:
+            # Only needed with motors, so headless runs do not need dynamixel_sdk
+            from shimi import Shimi
+            self.shimi = Shimi(LIMITS)
+            self.udp = NetworkHandler(UDP_PORT, self.network_callback, timeout_sec=0.25)
+        self.start_sec = 0
+        # Set by seek while nothing is playing. The next prepared song starts there instead of at its start time
+        self.pending_seek: Optional[float] = None
         self.paused = False
 
         self.song: Optional[Song] = None
 
-        signal.signal(signal.SIGINT, self.sig_handle)
-        self.shimi.start()
-        self.udp.start()
+        # Network commands are handled on prepare_thread so the receive thread only enqueues them.
+        # Every command bumps generation, and work for an older generation is dropped ("latest wins")
+        self.generation = 0
+        self.commands = queue.Queue()
+        self.prepare_thread = Thread(target=self.prepare_handler)
+        self.is_running = False
+        self.reported = False
+
+        if not headless:
+            signal.signal(signal.SIGINT, self.sig_handle)
+            self.shimi.start()
+            self.is_running = True
+            self.prepare_thread.start()
+            self.udp.start()
+            if gesture_seed is not None:
+                self.warm_gestures()
 
     def __del__(self):
-        self.terminate()
-
-    def load_gesture_library(self):
-        for p in os.listdir(self.gesture_lib_path):
-            path = os.path.join(self.gesture_lib_path, p)
-            if os.path.isdir(path):
-                temp = {}
-                slow = []
-                norm = []
-                for f in os.listdir(path):
-                    fpath = os.path.join(path, f)
-                    fname: str = os.path.splitext(f)[0]
-                    pace, genre, sno = fname.split('_')
-                    g = self.load_gesture(fpath)
-                    if int(pace) == Pace.SLOW:
-                        slow.append(g)
-                    elif int(pace) == Pace.NORMAL:
-                        norm.append(g)
-                    else:
-                        raise NotInRangeException
-                temp[Pace.SLOW] = slow
-                temp[Pace.NORMAL] = norm
-                self.gesture_library[Genre(p)] = temp
+        self.terminate(report=False)
 
     def sig_handle(self, num, frame):
         self.terminate()
 
-    def terminate(self):
-        self.audio_processor.terminate()
-        self.udp.terminate()
-        self.shimi.terminate()
+    def terminate(self, report=True):
+        """
+        :param report: print the audio and cache stats, once however many times this is called
+        """
+        self.join_prepare_thread()
+        self.audio_processor.terminate(report=report)
+        if report and not self.reported:
+            print(self.audio_cache)
+            print(self.gesture_library)
+            self.reported = True
+        if self.udp:
+            self.udp.terminate()
+        if self.shimi:
+            self.shimi.terminate()
 
     def join(self):
         self.audio_processor.stop()
-        self.udp.join()
-        self.shimi.join()
-
-    def beats2sec(self, beats):
-        return beats * (60.0 / self.song.tempo)
-
-    def sec2beats(self, duration):
-        return duration * self.song.tempo / 60.0
-
-    @staticmethod
-    def load_gesture(gesture_file: str):
-        # DS: [motor id, start beat absolute, position (0, 1), length in beats]
-        # Convert float values to int. beats -> samples, pos (0, 1) -> (0, 100)
-
-        raw_data = np.loadtxt(gesture_file, delimiter=',')
-
-        # Sort gestures in terms of their start times
-        g = raw_data[raw_data[:, 1].argsort()]
-
-        gestures = []
-        for i, line in enumerate(g):
-            gestures.append(Command(dxl_id=int(line[0]) - 1,
-                                    angle=line[2],
-                                    start_beat=line[1],
-                                    duration=line[3]))
-
-        return gestures
-
-    def compose_gestures(self):
-        song_gesture = []
-        offset = 0
-        last_idx = -1
-
-        # print(f"segments: {self.song.segments}")
-        for i in range(1, len(self.song.segments)):
-            # left and right boundaries
-            l, r = self.sec2beats(self.song.segments[i - 1].start), self.sec2beats(self.song.segments[i].start)
-            seg_len = r - l
-
-            pace: Pace = Pace.NORMAL if self.song.segments[i - 1].pace > PACE_THRESHOLD else Pace.SLOW
-            # choose a random gesture
-            gestures = self.gesture_library[self.song.genre][pace]
-
-            # choose a random index (non-repeating) for gesture
-            idx = random.choice([ii for ii in range(len(gestures)) if ii != last_idx])
-            last_idx = idx
-
-            g: List[Command] = gestures[idx]
-            g_dur = g[-1].start_beat + g[-1].duration
-            num_loops = int(seg_len // g_dur)
-            loop_dur = num_loops * g_dur
-            residual_dur = round(seg_len - loop_dur)
-
-            # loop / cut this gesture to fill this boundary
-            seg_gesture: List[Command] = []
-
-            # loop for num loops
-            for j in range(num_loops):
-                for c in g:
-                    c = copy(c)
-                    c.start_beat += offset
-                    seg_gesture.append(c)
-                offset += g_dur
-
-            # handle residual duration
-            cumsum_dur = 0
-            for c in g:
-                cumsum_dur += c.start_beat + c.duration
-                if cumsum_dur > residual_dur:
-                    break
-                c = copy(c)
-                c.start_beat += offset
-                seg_gesture.append(c)
-
-            offset += residual_dur
-
-            song_gesture.extend(seg_gesture)
-        # Adjust for feels
-        for i in range(len(song_gesture)):
-            song_gesture[i].start_beat += 0.25
-
-        return song_gesture
-
-    def prepare(self, song: Song = None):
-        if song:
-            self.song = song
-
-        if not self.song:
-            return
-
-        self.gesture_idx = 0
-        self.play_idx = 0
+        if self.udp:
+            self.udp.join()
+        self.join_prepare_thread()
+        if self.shimi:
+            self.shimi.join()
+
+    def join_prepare_thread(self):
+        self.is_running = False
+        if self.prepare_thread.is_alive():
+            self.commands.put_nowait(None)
+            self.prepare_thread.join()
+
+    def compose_gestures(self, song: Song = None) -> np.ndarray:
+        song = song or self.song
+        return self.gesture_library.compose(song.genre, song.tempo, song.segments,
+                                            seed=self.gesture_seed, song_id=song.id)
+
+    def warm_gestures(self, setlist: List[Tuple[Genre, str]] = None):
+        """
+        Compose the gestures of every song in setlist (the whole song library by default) in the background
+        """
+        if setlist is None:
+            setlist = [(Genre(k.split('/')[0]), k.split('/')[1]) for k in self.song_library.songs]
+
+        songs = []
+        for genre, name in setlist:
+            entry = self.song_library.get(genre, name)
+            if entry and genre in self.gesture_library:
+                songs.append((name, genre, entry["tempo"], entry["segmentation"]))
+        return self.gesture_library.warm(songs, self.gesture_seed)
+
+    def is_stale(self, generation: Optional[int]):
+        return generation is not None and generation != self.generation
+
+    def prepare(self, song: Song = None, generation: int = None) -> bool:
+        """
+        Render the haptics and compose the gestures of song. The result only replaces the current song once it is
+        complete, so an abandoned preparation leaves the performance as it was
+        :param generation: command generation this preparation is for. It is abandoned once a newer command arrives
+        :return: False if there is no song or the preparation was abandoned
+        """
+        song = song or self.song
+        if not song:
+            return False
+
+        prerendered = self.prerendered.load(song, self.gesture_library) if self.prerendered else None
+        if prerendered:
+            haptic_track = prerendered.haptic_track
+            gestures = prerendered.gestures
+            song.set_lyrics(prerendered.lyric_times, prerendered.lyric_text, prerendered.lyric_text_idx)
+        else:
+            haptic_track = self.render_haptics(song)
+            if self.is_stale(generation):
+                return False
+
+            gestures = GestureTimeline.compile(self.compose_gestures(song), song.tempo, self.fs)
+
+        if self.is_stale(generation):
+            return False
+
+        self.song = song
+        self.haptic_track = haptic_track
+        self.gestures = gestures
+        self.start_sec = song.start_time if self.pending_seek is None else self.pending_seek
+        self.pending_seek = None
+        return True
+
+    def render_haptics(self, song: Song = None):
+        """
+        Render the haptic mix for the whole song once, or load it from its sidecar file. It is kept in audio_cache
+        """
+        song = song or self.song
+        renderer = HapticRenderer(self.fs, HAPTIC_FILTERS[song.genre])
+        return self.audio_cache.get_haptic(song.audio_path, renderer, persist=self.persist_haptics)
+
+    def home(self):
+        if self.shimi:
+            self.shimi.stop(reset_positions=True)
 
-        self.gestures = self.compose_gestures()
+    def seek(self, seconds: float):
+        """
+        Jump to seconds in the current song. While playing, the audio moves at the next chunk and lyrics and
+        gestures follow in the callback. Otherwise the next song started, or the prepared one if it is resumed,
+        starts there
+        """
+        if self.audio_processor.is_playing:
+            self.audio_processor.seek(seconds)
+        else:
+            self.pending_seek = seconds
+            self.start_sec = seconds
 
     def stop(self):
         self.audio_processor.stop()
-        self.shimi.stop(reset_positions=True)
-        if self.song:
-            self.song.reset_lyric_idx()
+        self.home()
         self.paused = False
 
     def pause(self):
+        if not self.is_live():
+            return
+
         try:
-            self.shimi.stop(reset_positions=True)
+            self.home()
         except FastCommandException:
             pass
 
         self.audio_processor.pause()
         self.paused = True
 
+    def is_live(self):
+        """
+        True while the audio processor has a play thread for the current song, playing or paused
+        """
+        thread = self.audio_processor.play_thread
+        return thread is not None and thread.is_alive()
+
     def callback(self, data: np.ndarray):
-        # Haptic vibrations
-        audio = np.mean(data, axis=1)
-        data[:, 0] = audio
-        data[:, 1] = Util.biquad_lpf(audio, fc=100, fs=self.fs) * 1.25
+        # Haptic vibrations are prerendered in self.haptic_track, so data is played as is
 
-        # Motor actuation
-        l = self.play_idx * self.chunk_size / self.fs
-        r = (self.play_idx + 1) * self.chunk_size / self.fs
+        # Lyrics and gestures are looked up by the window this chunk covers, so seeks need no bookkeeping
+        frame = self.audio_processor.position
+        l = frame / self.fs
+        r = (frame + len(data)) / self.fs
 
-        lrc: List[dict[int, str]] = self.song.get_lyrics_between(l, r, num_future=2)
-        for line in lrc:
-            self.udp.queue_to_send(line)
+        # While the audio fades out after a pause nothing is dispatched
+        if self.paused:
+            return data
+
+        lo, hi = self.song.lyrics_range(l, r)
+        for i in range(lo, hi):
+            self.send_lyrics(l, self.song.lyric(i))
 
         # Add all the commands within this frame to the queue
-        if self.gesture_idx < len(self.gestures):
-            cmd: Command = self.gestures[self.gesture_idx]
-            while l <= self.beats2sec(cmd.start_beat) < r:
-                cmd.duration = self.beats2sec(cmd.duration)
-                self.shimi.append_command(cmd)
-                self.gesture_idx += 1
-                if self.gesture_idx >= len(self.gestures):
-                    break
-                cmd = self.gestures[self.gesture_idx]
-
-        self.play_idx += 1
+        g = self.gestures
+        lo, hi = g.range(frame, frame + len(data))
+        for dxl_id, angle, start, duration in zip(g.dxl_id[lo:hi].tolist(), g.angle[lo:hi].tolist(),
+                                                  g.start_beat[lo:hi].tolist(), g.duration[lo:hi].tolist()):
+            self.send_command(l, Command(dxl_id=dxl_id, angle=angle, start_beat=start, duration=duration))
         return data
 
+    def send_lyrics(self, t: float, line: dict):
+        if self.headless:
+            self.timeline.append((t, "lyrics", line))
+        else:
+            self.udp.queue_to_send(line)
+
+    def send_command(self, t: float, cmd: Command):
+        if self.headless:
+            self.timeline.append((t, "gesture", copy(cmd)))
+        else:
+            self.shimi.append_command(cmd)
+
     def song_complete_callback(self):
-        self.shimi.stop(reset_positions=True)
+        self.home()
+
+    def render(self, genre: Genre, song_name: str, sink: AudioSink = None, start_sec: float = None):
+        """
+        Play a whole song through the headless pipeline and return what was dispatched.
+        Runs faster than real time unless the sink is a realtime one
+        :param sink: where the audio goes for this song, e.g. a WavFileSink. Defaults to the current sink
+        :param start_sec: start from here instead of the song's start time
+        :return: timeline of (time in sec, event type, payload)
+        """
+        self.stop()
+        if start_sec is not None:
+            self.seek(start_sec)
+        self.prepare(self.song_library.song(genre, song_name, self.fs))
+        self.timeline = []
+
+        default_sink = self.audio_processor.sink
+        if sink:
+            self.audio_processor.sink = sink
+        try:
+            self.audio_processor.play(self.song.audio_path, delay_ms=0, block=True, start_sec=self.start_sec,
+                                      source=WavSource.from_array(self.haptic_track, self.fs, self.song.audio_path))
+        finally:
+            self.audio_processor.sink.close()
+            self.audio_processor.sink = default_sink
+        return self.timeline
 
     def network_callback(self, data: Packet):
+        """
+        Called on the network receive thread. Only hands the command to prepare_thread
+        """
+        self.generation += 1
+        self.commands.put_nowait((self.generation, data))
+
+    def prepare_handler(self):
+        while self.is_running:
+            item = self.commands.get()
+            if item is None:
+                break
+            generation, data = item
+            try:
+                self.handle_command(data, generation)
+            except Exception as e:
+                print(f"Error handling {data}: {e}")
+
+    def handle_command(self, data: Packet, generation: int = None):
         if data.command == NetworkCommand.START:
-            if not self.paused or (self.song and self.song.id != data.song):
+            # A START that a newer command already replaced is not worth loading
+            if self.is_stale(generation):
+                return
+            # Only resume when the paused song is really held by a play thread. A PAUSE that replaced a START
+            # mid-preparation leaves nothing to resume
+            resume = self.paused and self.audio_processor.paused and self.is_live() and \
+                self.song and self.song.id == data.song
+            if not resume:
                 self.stop()
-                self.prepare(Song(self.song_lib_path, Genre(data.genre), data.song, self.fs))
-                self.paused = False
-            self.audio_processor.play(self.song.audio_path, delay_ms=0, block=False)
+                song = self.song_library.song(Genre(data.genre), data.song, self.fs)
+                if self.is_stale(generation) or not self.prepare(song, generation):
+                    return
+            self.paused = False
+            self.audio_processor.play(self.song.audio_path, delay_ms=0, block=False, start_sec=self.start_sec,
+                                      source=WavSource.from_array(self.haptic_track, self.fs, self.song.audio_path))
         elif data.command == NetworkCommand.STOP:
             self.stop()
         elif data.command == NetworkCommand.PAUSE:
@@ -0,0 +1,200 @@
+"""
+Author: Raghavasimhan Sankaranarayanan
+Date created: 03/03/24
+"""
+
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import NamedTuple, Optional
+import numpy as np
+from definitions import *
+from gestureLibrary import GestureLibrary, GestureTimeline
+from haptics import HapticRenderer
+from resampler import Resampler
+from song import Song
+from songLibrary import SongLibrary
+from wavSource import WavSource
+
+
+class Prerendered(NamedTuple):
+    haptic_track: np.ndarray
+    gestures: GestureTimeline
+    lyric_times: np.ndarray
+    lyric_text: list
+    lyric_text_idx: np.ndarray
+
+
+class PrerenderStore:
+    """
+    On-disk store of everything Performance.prepare computes for a song: the haptic track, the compiled gesture
+    timeline and the lyric schedule, under <root>/v<VERSION>/<genre>/<song>.{npz,haptic.npy}.
+    manifest.json records what each song was rendered from (json, lrc and wav mtimes, gesture library version) and
+    with which sample rate, seed and haptic config, so only the songs where any of it changed are rendered again.
+    """
+    VERSION = 2
+    MANIFEST = "manifest.json"
+
+    def __init__(self, root: str, fs: int, seed: int = 0):
+        self.path = os.path.join(root, f"v{PrerenderStore.VERSION}")
+        self.manifest_path = os.path.join(self.path, PrerenderStore.MANIFEST)
+        self.fs = fs
+        self.seed = seed
+        self.songs: dict = {}
+        self.load_manifest()
+
+    def load_manifest(self):
+        try:
+            with open(self.manifest_path) as f:
+                self.songs = json.load(f)
+        except (OSError, ValueError):
+            self.songs = {}
+
+    def save_manifest(self):
+        tmp = self.manifest_path + ".tmp"
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with open(tmp, "w") as f:
+                json.dump(self.songs, f, indent=1)
+            os.replace(tmp, self.manifest_path)
+        except OSError as e:
+            print(f"Warning: Could not save prerender manifest {self.manifest_path}: {e}")
+
+    def base_path(self, genre: Genre, song_name: str):
+        return os.path.join(self.path, genre.value, song_name)
+
+    def stamp(self, song: Song, gesture_library: GestureLibrary) -> dict:
+        """
+        Everything a song's rendering depends on
+        """
+        return {"json": os.stat(song.meta_path).st_mtime_ns,
+                "lrc": os.stat(song.lyrics_path).st_mtime_ns,
+                "wav": os.stat(song.audio_path).st_mtime_ns,
+                "gestures": gesture_library.version(song.genre),
+                "haptic": HapticRenderer(self.fs, HAPTIC_FILTERS[song.genre]).config_hash,
+                "fs": self.fs,
+                "seed": self.seed}
+
+    def is_fresh(self, song: Song, gesture_library: GestureLibrary) -> bool:
+        entry = self.songs.get(SongLibrary.key(song.genre, song.id))
+        try:
+            return entry is not None and entry == self.stamp(song, gesture_library)
+        except OSError:
+            return False
+
+    def load(self, song: Song, gesture_library: GestureLibrary) -> Optional[Prerendered]:
+        """
+        :return: the prerendered song, or None if it is missing or out of date
+        """
+        if not self.is_fresh(song, gesture_library):
+            return None
+
+        base = self.base_path(song.genre, song.id)
+        try:
+            with np.load(base + ".npz", allow_pickle=False) as f:
+                gestures = GestureTimeline(*(f[name] for name in GestureTimeline._fields))
+                lyric_times, lyric_text_idx = f["lyric_times"], f["lyric_text_idx"]
+                lyric_text = f["lyric_text"].tolist()
+            haptic_track = np.load(base + ".haptic.npy", mmap_mode='r')
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Warning: Could not load prerendered {song.id}: {e}")
+            return None
+
+        for a in gestures:
+            a.flags.writeable = False
+        return Prerendered(haptic_track, gestures, lyric_times, lyric_text, lyric_text_idx)
+
+    @staticmethod
+    def render(song_root: str, gesture_root: str, genre: Genre, song_name: str, fs: int, seed: int, base: str):
+        """
+        Render one song into base.npz and base.haptic.npy. Runs in a worker process
+        """
+        song = Song(song_root, genre, song_name, fs)
+        lyrics = Song.read_lyrics(song.lyrics_path)
+
+        src = WavSource(song.audio_path)
+        data = Resampler.resample(src.data, src.fs, fs)
+        haptic_track = HapticRenderer(fs, HAPTIC_FILTERS[genre]).render(data)
+
+        gestures = GestureLibrary(gesture_root).compose(genre, song.tempo, song.segments, seed=seed)
+        timeline = GestureTimeline.compile(gestures, song.tempo, fs)
+
+        os.makedirs(os.path.dirname(base), exist_ok=True)
+        np.savez(base + ".tmp.npz", lyric_times=lyrics.times, lyric_text=np.array(lyrics.text_table, dtype=str),
+                 lyric_text_idx=lyrics.text_idx, **timeline._asdict())
+        with open(base + ".haptic.tmp", "wb") as f:
+            np.save(f, haptic_track)
+        os.replace(base + ".tmp.npz", base + ".npz")
+        os.replace(base + ".haptic.tmp", base + ".haptic.npy")
+
+    def update(self, song_root: str, gesture_root: str, workers: int = None, force=False):
+        """
+        Render every song of the library that is not in the store or out of date, in parallel
+        :param workers: number of processes, all cores by default
+        :param force: render every song
+        :return: number of songs rendered
+        """
+        library = SongLibrary(song_root)
+        gesture_library = GestureLibrary(gesture_root)
+
+        jobs = []
+        for key in sorted(library.songs):
+            genre, name = Genre(key.split('/')[0]), key.split('/')[1]
+            try:
+                song = library.song(genre, name, self.fs)
+                if not os.path.exists(song.audio_path) or not os.path.exists(song.lyrics_path) or \
+                        genre not in gesture_library:
+                    continue
+                # Compiles the genre's gesture cache here once instead of in every worker
+                stamp = self.stamp(song, gesture_library)
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Skipping {key}: {e}")
+                continue
+            if force or self.songs.get(key) != stamp:
+                jobs.append((os.path.getsize(song.audio_path), key, genre, name, stamp))
+
+        for key in set(self.songs) - set(library.songs):
+            del self.songs[key]
+
+        # Longest songs first so the pool finishes evenly
+        jobs.sort(key=lambda j: -j[0])
+        rendered = 0
+        try:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = {pool.submit(PrerenderStore.render, song_root, gesture_root, genre, name, self.fs, self.seed,
+                                       self.base_path(genre, name)): (key, stamp)
+                           for _, key, genre, name, stamp in jobs}
+                for future in as_completed(futures):
+                    key, stamp = futures[future]
+                    try:
+                        future.result()
+                    except Exception as e:
+                        print(f"Failed to render {key}: {e}")
+                        self.songs.pop(key, None)
+                        continue
+                    self.songs[key] = stamp
+                    rendered += 1
+                    print(f"[{rendered}/{len(jobs)}] {key}")
+        finally:
+            self.save_manifest()
+        return rendered
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Prerender the haptic tracks, gesture timelines and lyric schedules "
+                                                 "of the whole song library")
+    parser.add_argument("--songs", default="songs", help="song library path")
+    parser.add_argument("--gestures", default="gestures", help="gesture library path")
+    parser.add_argument("--out", default="prerendered", help="store path")
+    parser.add_argument("--fs", type=int, default=48000, help="sample rate to render at")
+    parser.add_argument("--seed", type=int, default=0, help="gesture composition seed")
+    parser.add_argument("--workers", type=int, default=None, help="number of processes (all cores by default)")
+    parser.add_argument("--force", action="store_true", help="render every song even if it is up to date")
+    args = parser.parse_args()
+
+    t = time.time()
+    store = PrerenderStore(args.out, args.fs, args.seed)
+    n = store.update(args.songs, args.gestures, workers=args.workers, force=args.force)
+    print(f"Rendered {n} songs in {time.time() - t:.1f} sec")
@@ -0,0 +1,177 @@
+"""
+Author: Raghavasimhan Sankaranarayanan
+Date created: 03/03/24
+"""
+
+import math
+import numpy as np
+from scipy import signal
+from wavSource import WavSource
+
+
+class Resampler:
+    @staticmethod
+    def ratio(fs_in: int, fs_out: int):
+        """
+        :return: (up, down) factors of the rational conversion fs_out / fs_in
+        """
+        g = math.gcd(int(fs_in), int(fs_out))
+        return int(fs_out) // g, int(fs_in) // g
+
+    @staticmethod
+    def design_filter(up: int, down: int):
+        """
+        Linear phase low-pass prototype, the same one scipy.signal.resample_poly designs by default
+        """
+        max_rate = max(up, down)
+        half_len = 10 * max_rate
+        return signal.firwin(2 * half_len + 1, 1. / max_rate, window=('kaiser', 5.0))
+
+    @staticmethod
+    def to_dtype(x: np.ndarray, dtype):
+        if np.issubdtype(dtype, np.integer):
+            info = np.iinfo(dtype)
+            x = np.clip(np.round(x), info.min, info.max)
+        return x.astype(dtype)
+
+    @staticmethod
+    def resample(data: np.ndarray, fs_in: int, fs_out: int) -> np.ndarray:
+        """
+        Polyphase resampling of a whole signal along the first axis
+        :param data: samples with shape (num_frames, channels)
+        :return: resampled samples with the same dtype as data
+        """
+        if fs_in == fs_out:
+            return data
+        up, down = Resampler.ratio(fs_in, fs_out)
+        y = signal.resample_poly(np.asarray(data, dtype=np.float32), up, down, axis=0,
+                                 window=Resampler.design_filter(up, down))
+        return Resampler.to_dtype(y, data.dtype)
+
+
+class StreamingResampler:
+    """
+    Polyphase resampler that converts a signal chunk by chunk, keeping the last inputs between calls so that the
+    concatenated output matches Resampler.resample on the whole signal.
+    """
+    def __init__(self, fs_in: int, fs_out: int, channels: int):
+        self.up, self.down = Resampler.ratio(fs_in, fs_out)
+        h = Resampler.design_filter(self.up, self.down) * self.up
+        self.half_len = (len(h) - 1) // 2
+
+        # phases[p, t] = h[p + t * up]
+        self.taps = int(math.ceil(len(h) / self.up))
+        padded = np.zeros(self.taps * self.up)
+        padded[:len(h)] = h
+        self.phases = padded.reshape((self.taps, self.up)).T.copy()
+
+        self.channels = channels
+        self.history = np.zeros((self.taps - 1, channels))
+        self.num_in = 0
+        self.num_out = 0
+
+    def reset(self):
+        self.history[:] = 0
+        self.num_in = 0
+        self.num_out = 0
+
+    @property
+    def expected_output(self):
+        """ Number of outputs the whole signal read so far produces """
+        return -(-self.num_in * self.up // self.down)
+
+    def process(self, x: np.ndarray) -> np.ndarray:
+        """
+        :param x: next input chunk with shape (n, channels)
+        :return: every output sample that only depends on the inputs seen so far, shape (m, channels)
+        """
+        buf = np.concatenate((self.history, x), axis=0)
+        first_in = self.num_in - (self.taps - 1)
+        self.num_in += len(x)
+
+        # Output m is centered on upsampled index m * down, so it needs inputs up to (m * down + half_len) // up
+        num = self.num_in * self.up - 1 - self.half_len
+        end = num // self.down + 1 if num >= 0 else 0
+        m = np.arange(self.num_out, max(end, self.num_out))
+        self.num_out = max(end, self.num_out)
+        self.history = buf[len(buf) - (self.taps - 1):]
+
+        n = m * self.down + self.half_len
+        idx = (n // self.up)[:, None] - np.arange(self.taps)[None, :] - first_in
+        return np.einsum('mt,mtc->mc', self.phases[n % self.up], buf[idx])
+
+    def flush(self) -> np.ndarray:
+        """
+        Zero pad the end of the signal and return the remaining outputs
+        """
+        total = self.expected_output
+        num_in = self.num_in
+        y = self.process(np.zeros((self.taps + self.half_len // self.up + 1, self.channels)))
+        self.num_in = num_in
+        return y[:max(total - (self.num_out - len(y)), 0)]
+
+
+class ResamplingSource:
+    """
+    Wraps a WavSource at another sample rate and resamples it chunk by chunk as it is read
+    """
+    def __init__(self, source: WavSource, fs: int, chunk_size=1024):
+        self.source = source
+        self.fs = fs
+        self.chunk_size = chunk_size
+        self.resampler = StreamingResampler(source.fs, fs, source.channels)
+        self.pending = np.zeros((0, source.channels))
+        self.eof = False
+        self.idx = 0
+
+    @property
+    def path(self):
+        return self.source.path
+
+    @property
+    def channels(self):
+        return self.source.channels
+
+    @property
+    def sampwidth(self):
+        return self.source.sampwidth
+
+    @property
+    def dtype(self):
+        return self.source.dtype
+
+    @property
+    def num_frames(self):
+        return -(-self.source.num_frames * self.resampler.up // self.resampler.down)
+
+    @property
+    def duration(self):
+        return self.num_frames / self.fs
+
+    def seek(self, frame: int):
+        frame = min(max(int(frame), 0), self.num_frames)
+        self.source.seek(round(frame * self.source.fs / self.fs))
+        self.resampler.reset()
+        self.pending = np.zeros((0, self.channels))
+        self.eof = False
+        self.idx = frame
+
+    def seek_sec(self, seconds: float):
+        self.seek(round(seconds * self.fs))
+
+    def tell(self):
+        return self.idx
+
+    def read(self, num_frames: int):
+        while len(self.pending) < num_frames and not self.eof:
+            x = self.source.read(self.chunk_size)
+            if len(x):
+                y = self.resampler.process(x)
+            else:
+                y = self.resampler.flush()
+                self.eof = True
+            self.pending = np.concatenate((self.pending, y), axis=0)
+
+        data, self.pending = self.pending[:num_frames], self.pending[num_frames:]
+        self.idx += len(data)
+        return Resampler.to_dtype(data, self.dtype)
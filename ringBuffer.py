@@ -0,0 +1,70 @@
+"""
+Author: Raghavasimhan Sankaranarayanan
+Date created: 03/03/24
+"""
+
+import numpy as np
+
+
+class RingBuffer:
+    """
+    Single producer / single consumer ring of preallocated audio chunks.
+    The producer (play thread) pushes encoded chunks ahead of time and the PyAudio device callback pops them.
+    No locks are taken: each index is only ever advanced by one side.
+    """
+    def __init__(self, num_slots: int, chunk_size: int, channels: int, dtype=np.int16):
+        # One slot is always held by the consumer while PyAudio copies it out, so allocate one extra
+        self.num_slots = num_slots + 1
+        self.buffer = np.zeros((self.num_slots, chunk_size * channels), dtype=dtype)
+        self.views = [memoryview(self.buffer[i]).cast('B').toreadonly() for i in range(self.num_slots)]
+        self.silence = memoryview(np.zeros(chunk_size * channels, dtype=dtype)).cast('B').toreadonly()
+
+        self.write_idx = 0
+        self.read_idx = 0
+        self._in_flight = False
+
+    def reset(self):
+        self.write_idx = 0
+        self.read_idx = 0
+        self._in_flight = False
+
+    @property
+    def available(self):
+        """ Number of chunks pushed but not yet popped """
+        return self.write_idx - self.read_idx - (1 if self._in_flight else 0)
+
+    @property
+    def full(self):
+        return self.write_idx - self.read_idx >= self.num_slots
+
+    def push(self, data) -> bool:
+        """
+        Copy one chunk into the next free slot. Short chunks are padded with silence
+        :param data: bytes-like chunk of interleaved samples
+        :return: False if the ring is full
+        """
+        if self.full:
+            return False
+
+        samples = np.frombuffer(data, dtype=self.buffer.dtype)
+        slot = self.buffer[self.write_idx % self.num_slots]
+        n = len(samples)
+        slot[:n] = samples
+        slot[n:] = 0
+        self.write_idx += 1
+        return True
+
+    def pop(self):
+        """
+        Release the previously popped slot and return a read-only byte view of the next one
+        :return: memoryview or None if nothing is available
+        """
+        if self._in_flight:
+            self.read_idx += 1
+            self._in_flight = False
+
+        if self.write_idx == self.read_idx:
+            return None
+
+        self._in_flight = True
+        return self.views[self.read_idx % self.num_slots]
@@ -8,36 +8,49 @@ import queue
 import time
 
 import dynamixel_sdk as dxl
+import numpy as np
 from definitions import *
 from exceptions import *
 from typing import List, Tuple
 from motor import Motor
 from threading import Thread, Condition, Lock
-from dataclasses import dataclass
-
-
-@dataclass
-class Command:
-    dxl_id: int = -1
-    angle: float = 0
-    start_beat: float = 0
-    duration: float = 0
-
-    @property
-    def is_valid(self):
-        return self.dxl_id >= 0 and self.duration > 0
-
-    def __repr__(self):
-        return f"id: {self.dxl_id} \t angle: {self.angle} \t start: {self.start_beat} \t period: {self.duration:.3f}sec"
+from command import Command
 
 
 class Shimi:
-    def __init__(self, limits: List[LIMIT]):
+    def __init__(self, limits: List[LIMIT], sync_write=SYNC_WRITE, feedback_rate=FEEDBACK_RATE_HZ):
+        """
+        :param sync_write: send the commands pending in each control tick, and homing, as one GroupSyncWrite packet
+        instead of two writes per motor
+        :param feedback_rate: rate in Hz at which the present position of every motor is read in one bulk read
+        into self.positions. 0 disables it
+        """
         self.port = None
         if not SIMULATE:
             self.port = dxl.PortHandler(PORT_NAME)
             self.__init_port__()
-        self.motors = [Motor(self.port, i, limits[i]) for i in range(len(limits))]
+        # Serializes all traffic on the port, and the param and data tables of the group packets below with it
+        self.bus_lock = Lock()
+        self.motors = [Motor(self.port, i, limits[i], bus_lock=self.bus_lock) for i in range(len(limits))]
+
+        # Present position of every motor, shared with the motors. Negative until read
+        self.positions = np.full(len(self.motors), -1, dtype=np.int32)
+        self.feedback_rate = feedback_rate
+        self.feedback_thread = Thread(target=self.feedback_handler)
+        self.group_bulk_read = None
+        if feedback_rate > 0 and not SIMULATE:
+            # Protocol 1 has no sync read, but MX motors support bulk read
+            self.group_bulk_read = dxl.GroupBulkRead(self.port, dxl.PacketHandler(protocol_version=1))
+            for m in self.motors:
+                self.group_bulk_read.addParam(m.id + 1, ADDR.PRESENT_POSITION, m.byte_map.POSITION)
+                m.feedback = self.positions
+
+        self.sync_write = sync_write
+        self.group_sync_write = None
+        if sync_write and not SIMULATE:
+            byte_map = PARAM_BYTE_LENGTH_MAP()
+            self.group_sync_write = dxl.GroupSyncWrite(self.port, dxl.PacketHandler(protocol_version=1),
+                                                       ADDR.GOAL_POSITION, byte_map.POSITION + byte_map.VELOCITY)
 
         self.is_running = False
         self.cmd_queue = queue.Queue()
@@ -72,9 +85,13 @@ class Shimi:
         :return:
         """
         for i, m in enumerate(self.motors):
-            m.enable(wait=i == len(self.motors) - 1)
+            m.enable(wait=i == len(self.motors) - 1, home=not self.sync_write)
+        if self.sync_write:
+            self.home(wait=True)
         self.is_running = True
         self.thread.start()
+        if self.group_bulk_read:
+            self.feedback_thread.start()
 
     def join(self):
         self.is_running = False
@@ -82,6 +99,8 @@ class Shimi:
 
         if self.thread.is_alive():
             self.thread.join()
+        if self.feedback_thread.is_alive():
+            self.feedback_thread.join()
 
     def stop(self, reset_positions=True):
         """
@@ -91,8 +110,60 @@ class Shimi:
         :return: None
         """
         self.cmd_queue = queue.Queue()
-        for i, m in enumerate(self.motors):
-            m.reset_position(wait=i == len(self.motors) - 1)
+        if not reset_positions:
+            return
+
+        if self.sync_write:
+            self.home(wait=True)
+        else:
+            for i, m in enumerate(self.motors):
+                m.reset_position(wait=i == len(self.motors) - 1)
+
+    def home(self, wait=False):
+        """
+        Move every motor to its initial position with a single sync write
+        """
+        self.move_motors([(i, INITIAL_POSITIONS[i], 1) for i in range(len(self.motors))], wait=wait)
+
+    def move_motors(self, moves: List[Tuple[int, int, float]], wait=False):
+        """
+        Move several motors with one GroupSyncWrite packet holding the goal position and velocity of each.
+        Motors that were commanded too recently are skipped
+        :param moves: (motor id, position in ticks, duration in sec) of each motor, at most one per motor
+        :param wait: block until the motors reach their positions
+        """
+        planned = []
+        for dxl_id, position, duration in moves:
+            m = self.motors[dxl_id]
+            try:
+                planned.append((m, position, m.plan_move(position, duration)))
+            except FastCommandException:
+                print("Fast command!")
+
+        if not planned:
+            return
+
+        if not SIMULATE:
+            # The param table is shared by home() on other threads and send_tick() on this one, so it is filled, sent
+            # and cleared under the bus lock in one go
+            with self.bus_lock:
+                for m, position, rpm_ticks in planned:
+                    if not self.group_sync_write.addParam(m.id + 1, Motor.goal_params(position, rpm_ticks)):
+                        print(f"Warning: Could not add motor {m.id} to the sync write")
+                res = self.group_sync_write.txPacket()
+                self.group_sync_write.clearParam()
+            if res != dxl.COMM_SUCCESS:
+                print("Dynamixel Communication Error")
+                return
+        else:
+            time.sleep(0.005)
+
+        for m, position, _ in planned:
+            m.moved(position)
+
+        if wait:
+            for m, position, _ in planned:
+                m.wait_for(position)
 
     def append_command(self, command: Command):
         with self.cv:
@@ -107,17 +178,65 @@ class Shimi:
                 if not self.is_running:
                     break
 
-            # There can be spurious awake. Use try catch to eliminate null
-                try:
-                    cmd: Command = copy.copy(self.cmd_queue.get_nowait())
-                except queue.Empty:
-                    continue
-                self.cmd_queue.task_done()
-
-            if not cmd.is_valid:
+                # Take every command pending in this tick. There can be spurious awakes, so it may be none
+                cmds: List[Command] = []
+                while True:
+                    try:
+                        cmds.append(copy.copy(self.cmd_queue.get_nowait()))
+                    except queue.Empty:
+                        break
+                    self.cmd_queue.task_done()
+
+            cmds = [cmd for cmd in cmds if cmd.is_valid]
+            if not cmds:
                 continue
 
             # We don't need to worry about time here since the commands are appended at the time it needs to be executed
             # print(i, cmd)
-            i += 1
-            self.motors[cmd.dxl_id].rotate(cmd.angle, cmd.duration, is_percent=True)
+            i += len(cmds)
+            if self.sync_write:
+                self.send_tick(cmds)
+            else:
+                for cmd in cmds:
+                    self.motors[cmd.dxl_id].rotate(cmd.angle, cmd.duration, is_percent=True)
+
+    def read_positions(self) -> bool:
+        """
+        Read the present position of every motor in one bulk read transaction into self.positions
+        :return: False if the transaction failed
+        """
+        with self.bus_lock:
+            res = self.group_bulk_read.txRxPacket()
+            if res != dxl.COMM_SUCCESS:
+                return False
+
+            for m in self.motors:
+                if self.group_bulk_read.isAvailable(m.id + 1, ADDR.PRESENT_POSITION, m.byte_map.POSITION):
+                    self.positions[m.id] = self.group_bulk_read.getData(m.id + 1, ADDR.PRESENT_POSITION,
+                                                                        m.byte_map.POSITION)
+        return True
+
+    def feedback_handler(self):
+        period = 1.0 / self.feedback_rate
+        t = time.time()
+        while self.is_running:
+            if not self.read_positions():
+                print("Dynamixel Communication Error: bulk read failed")
+            t += period
+            time.sleep(max(0.0, t - time.time()))
+            # Skip ticks that were missed instead of bursting to catch up
+            t = max(t, time.time() - period)
+
+    def send_tick(self, cmds: List[Command]):
+        """
+        Send the commands of a control tick with one sync write. A motor can only take one of them, the others are
+        too fast for it and dropped, as they would be when written one by one
+        """
+        moves = {}
+        for cmd in cmds:
+            if cmd.dxl_id in moves:
+                print("Fast command!")
+                continue
+            m = self.motors[cmd.dxl_id]
+            moves[cmd.dxl_id] = (cmd.dxl_id, m.target_ticks(cmd.angle, is_percent=True), cmd.duration)
+        self.move_motors(list(moves.values()))
@@ -4,11 +4,11 @@ Date created: 03/03/24
 """
 
 import json
-import pylrc
-from pylrc.classes import LyricLine
+import numpy as np
 from typing import List, Tuple, Optional, NamedTuple
 import os
 from definitions import *
+from lrcParser import LrcParser, Lyrics
 
 
 class Song:
@@ -16,7 +16,10 @@ class Song:
         start: float
         pace: float
 
-    def __init__(self, library_root_path: str, genre: Genre, song_name, sample_rate=44100):
+    def __init__(self, library_root_path: str, genre: Genre, song_name, sample_rate=44100, index_entry: dict = None):
+        """
+        :param index_entry: this song's entry from SongLibrary. If given, nothing is read from disk
+        """
         self.library_path = library_root_path
         self._genre = genre
         self._song_name = song_name
@@ -24,15 +27,22 @@ class Song:
         self.meta_path = os.path.join(library_root_path, genre.value, song_name + ".json")
         self.lyrics_path = os.path.join(library_root_path, genre.value, song_name + ".lrc")
 
-        self._lyrics: List[LyricLine] = []
+        # Lyric timeline: time stamps in seconds, index of each line's text in the interned text table,
+        # and the payload sent for each line (its text plus LYRIC_LOOKAHEAD future lines)
+        self._lyric_times = np.zeros(0)
+        self._text_table: List[str] = []
+        self._text_idx = np.zeros(0, dtype=np.int32)
+        self._payloads: List[dict[int, str]] = []
         self._segments = []
         self.bpm = 120
         self.fs = sample_rate
         self.start = 0
-        self.lrc_idx = 0
 
-        self.parse_json()
-        self.load_lyrics()
+        if index_entry:
+            self.load_index_entry(index_entry)
+        else:
+            self.parse_json()
+            self.load_lyrics()
 
     @property
     def id(self):
@@ -58,10 +68,29 @@ class Song:
     def segments(self):
         return self._segments
 
-    def reset_lyric_idx(self):
-        self.lrc_idx = 0
+    @property
+    def num_lyrics(self):
+        return len(self._lyric_times)
+
+    def lyric_text(self, i: int):
+        return self._text_table[self._text_idx[i]]
+
+    def lyric(self, i: int) -> dict[int, str]:
+        """
+        Precomputed payload of line i: its text with key 0 and LYRIC_LOOKAHEAD future lines with keys 1, 2, ...
+        """
+        return self._payloads[i]
+
+    def lyrics_range(self, min_sec: float, max_sec: float) -> Tuple[int, int]:
+        """
+        Indices [lo, hi) of the lyric lines with min_sec <= time < max_sec. Works for any window, in any order
+        """
+        lo = int(np.searchsorted(self._lyric_times, min_sec, side='left'))
+        hi = int(np.searchsorted(self._lyric_times, max_sec, side='left'))
+        return lo, hi
 
-    def get_lyrics_between(self, min_sec: float, max_sec: float, num_future: int = 2) -> List[dict[int, str]]:
+    def get_lyrics_between(self, min_sec: float, max_sec: float,
+                           num_future: int = LYRIC_LOOKAHEAD) -> List[dict[int, str]]:
         """
         returns List because there may be multiple lyric lines in the timeframe
         :param min_sec: minimum time stamp
@@ -69,29 +98,28 @@ class Song:
         :param num_future: Number of future lyrics to return
         :return: list of dicts each containing the lyrics and futures with keys 0, 1, 2, ...
         """
-        lrc = []
+        lo, hi = self.lyrics_range(min_sec, max_sec)
+        if num_future == LYRIC_LOOKAHEAD:
+            return self._payloads[lo:hi]
+        return [self.make_payload(i, num_future) for i in range(lo, hi)]
 
-        # Move lrc pointer to the minimum time since we don't need anything before this point in time
-        while self.lrc_idx < len(self._lyrics) and self._lyrics[self.lrc_idx].time < min_sec:
-            self.lrc_idx += 1
-
-        while self.lrc_idx < len(self._lyrics) and self._lyrics[self.lrc_idx].time < max_sec:
-            tmp = {0: self._lyrics[self.lrc_idx].text}
-            for i in range(1, num_future + 1):
-                tmp[i] = self._lyrics[self.lrc_idx + i].text if self.lrc_idx + i < len(self._lyrics) else ""
-
-            lrc.append(tmp)
-            self.lrc_idx += 1
-        return lrc
+    def make_payload(self, i: int, num_future: int) -> dict[int, str]:
+        payload = {0: self.lyric_text(i)}
+        for j in range(1, num_future + 1):
+            payload[j] = self.lyric_text(i + j) if i + j < self.num_lyrics else ""
+        return payload
 
     def parse_json(self):
-        with open(self.meta_path) as f:
-            data = json.load(f)
-
+        data = self.read_meta(self.meta_path)
         self._segments = self.parse_segmentation(data["segmentation"])
         self.bpm = data["tempo"]
         self.start = data["start"]
 
+    @staticmethod
+    def read_meta(meta_path: str) -> dict:
+        with open(meta_path) as f:
+            return json.load(f)
+
     @staticmethod
     def parse_segmentation(data: List[Tuple[float, float]]):
         segments: List[Song.Segment] = []
@@ -99,6 +127,25 @@ class Song:
             segments.append(Song.Segment(s, p))
         return segments
 
+    @staticmethod
+    def read_lyrics(lyrics_path: str) -> Lyrics:
+        """
+        :return: sorted time stamps in seconds, table of unique lines and the index of each line in it
+        """
+        return LrcParser.parse_file(lyrics_path)
+
     def load_lyrics(self):
-        with open(self.lyrics_path) as f:
-            self._lyrics = pylrc.parse(f.read())
+        lyrics = self.read_lyrics(self.lyrics_path)
+        self.set_lyrics(lyrics.times, lyrics.text_table, lyrics.text_idx)
+
+    def set_lyrics(self, times, text_table: List[str], text_idx):
+        self._lyric_times = np.asarray(times, dtype=np.float64)
+        self._text_table = text_table
+        self._text_idx = np.asarray(text_idx, dtype=np.int32)
+        self._payloads = [self.make_payload(i, LYRIC_LOOKAHEAD) for i in range(self.num_lyrics)]
+
+    def load_index_entry(self, entry: dict):
+        self._segments = self.parse_segmentation(entry["segmentation"])
+        self.bpm = entry["tempo"]
+        self.start = entry["start"]
+        self.set_lyrics(entry["lyric_times"], entry["lyric_text"], entry["lyric_text_idx"])
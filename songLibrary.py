@@ -0,0 +1,112 @@
+"""
+Author: Raghavasimhan Sankaranarayanan
+Date created: 03/03/24
+"""
+
+import json
+import os
+from typing import Optional
+from definitions import *
+from song import Song
+
+
+class SongLibrary:
+    """
+    Index of every song under <root>/<genre>/ holding its tempo, start, segmentation and parsed lyrics, so that a Song
+    can be built without touching its json or lrc files. The index is stored in a single json file in the root and
+    only the songs whose files changed since the last scan are parsed again.
+    """
+    INDEX_FILE = ".index.json"
+    VERSION = 4
+
+    def __init__(self, root: str):
+        self.root = root
+        self.index_path = os.path.join(root, SongLibrary.INDEX_FILE)
+        self.songs: dict = {}
+        self.load()
+        self.update()
+
+    @staticmethod
+    def key(genre: Genre, song_name: str):
+        return f"{genre.value}/{song_name}"
+
+    def load(self):
+        try:
+            with open(self.index_path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        if data.get("version") == SongLibrary.VERSION:
+            self.songs = data["songs"]
+
+    def save(self):
+        tmp = self.index_path + ".tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump({"version": SongLibrary.VERSION, "songs": self.songs}, f, separators=(',', ':'))
+            os.replace(tmp, self.index_path)
+        except OSError as e:
+            print(f"Warning: Could not save song index {self.index_path}: {e}")
+
+    def update(self):
+        """
+        Rescan the library and re-parse only the songs whose json or lrc changed
+        :return: number of songs parsed
+        """
+        songs = {}
+        parsed = 0
+        for genre in Genre:
+            path = os.path.join(self.root, genre.value)
+            if not os.path.isdir(path):
+                continue
+
+            for f in os.listdir(path):
+                name, ext = os.path.splitext(f)
+                if ext != ".json":
+                    continue
+
+                meta_path = os.path.join(path, f)
+                lyrics_path = os.path.join(path, name + ".lrc")
+                mtimes = [os.path.getmtime(meta_path),
+                          os.path.getmtime(lyrics_path) if os.path.exists(lyrics_path) else 0]
+
+                key = self.key(genre, name)
+                entry = self.songs.get(key)
+                if not entry or entry["mtimes"] != mtimes:
+                    entry = self.parse(meta_path, lyrics_path)
+                    entry["mtimes"] = mtimes
+                    parsed += 1
+                songs[key] = entry
+
+        changed = parsed > 0 or songs.keys() != self.songs.keys()
+        self.songs = songs
+        if changed:
+            self.save()
+        return parsed
+
+    @staticmethod
+    def parse(meta_path: str, lyrics_path: str) -> dict:
+        meta = Song.read_meta(meta_path)
+        if os.path.exists(lyrics_path):
+            lyrics = Song.read_lyrics(lyrics_path)
+            times, text_table, text_idx = lyrics.times.tolist(), lyrics.text_table, lyrics.text_idx.tolist()
+        else:
+            times, text_table, text_idx = [], [], []
+        return {
+            "tempo": meta["tempo"],
+            "start": meta["start"],
+            "segmentation": meta["segmentation"],
+            "lyric_times": times,
+            "lyric_text": text_table,
+            "lyric_text_idx": text_idx,
+        }
+
+    def get(self, genre: Genre, song_name: str) -> Optional[dict]:
+        return self.songs.get(self.key(genre, song_name))
+
+    def song(self, genre: Genre, song_name: str, sample_rate=44100) -> Song:
+        """
+        Build a Song from the index. Falls back to reading its files if it is not indexed
+        """
+        return Song(self.root, genre, song_name, sample_rate, index_entry=self.get(genre, song_name))
@@ -4,29 +4,40 @@ Date created: 03/03/24
 """
 
 import numpy as np
-from enum import IntEnum
-
-
-class FilterType(IntEnum):
-    LOW_PASS = 0
-    HIGH_PASS = 1
-    BAND_PASS = 2
-    NOTCH = 3
-    PEAK = 4
-    LOW_SHELF = 5
-    HIGH_SHELF = 6
+from scipy import signal
+from typing import List
+from definitions import FilterType, FilterSpec
 
 
 class Util:
     @staticmethod
-    def zero_lpf(x: np.ndarray, alpha):
-        y = x.copy()
-        for i in range(1, len(x)):
-            y[i] = (alpha * y[i - 1]) + ((1 - alpha) * y[i])
+    def zero_lpf(x: np.ndarray, alpha, axis=0):
+        """
+        Zero-phase one-pole smoothing: a forward pass followed by a backward pass, each seeded with the edge sample
+        :param x: signal to smooth
+        :param alpha: pole of the filter (0 -> no smoothing)
+        :param axis: axis along which to smooth
+        :return: smoothed signal with the same shape as x
+        """
+        x = np.asarray(x, dtype=float)
+        if x.shape[axis] == 0:
+            return x.copy()
+
+        b, a = [1 - alpha], [1, -alpha]
+        zi = alpha * np.take(x, [0], axis=axis)
+        y, _ = signal.lfilter(b, a, x, axis=axis, zi=zi)
+
+        y = np.flip(y, axis=axis)
+        zi = alpha * np.take(y, [0], axis=axis)
+        y, _ = signal.lfilter(b, a, y, axis=axis, zi=zi)
+        return np.flip(y, axis=axis)
 
-        for i in range(len(x) - 2, -1, -1):
-            y[i] = (alpha * y[i + 1]) + ((1 - alpha) * y[i])
-        return y
+    @staticmethod
+    def zero_lpf_batch(x: np.ndarray, alpha):
+        """
+        Smooth every row of a 2D array (num_signals, num_samples) at once with zero_lpf
+        """
+        return Util.zero_lpf(x, alpha, axis=-1)
 
     @staticmethod
     def get_biquad_coeff(filter_type: FilterType, fc, fs, Q, gain):
@@ -84,7 +95,7 @@ class Util:
 
         elif filter_type == FilterType.LOW_SHELF:
             if gain >= 0:  # boost
-                norm = 1 / (1 + np.SQRT2 * K + K * K)
+                norm = 1 / (1 + np.sqrt(2) * K + K * K)
                 a0 = (1 + np.sqrt(2 * V) * K + V * K * K) * norm
                 a1 = 2 * (V * K * K - 1) * norm
                 a2 = (1 - np.sqrt(2 * V) * K + V * K * K) * norm
@@ -122,18 +133,52 @@ class Util:
     # refer: https://arachnoid.com/BiQuadDesigner/index.html
     @staticmethod
     def biquad_lpf(x: np.ndarray, fc, fs, Q=0.707, gain=1):
-        b0, b1, b2, a1, a2 = Util.get_biquad_coeff(FilterType.LOW_PASS, fc, fs, Q, gain)
-        x1, x2, y1, y2 = 0, 0, 0, 0
-
-        def step(_x, _x1, _x2, _y1, _y2):
-            _y = b0 * _x + b1 * _x1 + b2 * _x2 - a1 * _y1 - a2 * _y2
-            return _y
-
-        y = x.copy()
-        for i in range(len(x)):
-            y[i] = step(x[i], x1, x2, y1, y2)
-            x2 = x1
-            x1 = x[i]
-            y2 = y1
-            y1 = y[i]
+        """
+        Low pass a whole signal from rest in one call
+        """
+        return BiquadFilter(FilterType.LOW_PASS, fc, fs, Q, gain).process(np.asarray(x, dtype=float))
+
+
+class FilterBank:
+    """
+    Cascade of biquads (second-order sections) run over all channels in one pass per block.
+    Keeps the delay line of every section across calls, so consecutive chunks are filtered as one continuous signal.
+    """
+    def __init__(self, specs: List[FilterSpec], fs, channels=1):
+        self.specs = specs
+        self.channels = channels
+        self.sos = np.zeros((len(specs), 6))
+        for i, spec in enumerate(specs):
+            b0, b1, b2, a1, a2 = Util.get_biquad_coeff(spec.filter_type, spec.fc, fs, spec.Q, spec.gain)
+            self.sos[i] = [b0, b1, b2, 1, a1, a2]
+        self.zi = np.zeros((len(specs), 2, channels))
+
+    def reset(self):
+        self.zi[:] = 0
+
+    def process(self, x: np.ndarray):
+        """
+        Filter a block of samples along the first axis through every section of the cascade
+        :param x: array with shape (chunk_size,) or (chunk_size, channels)
+        :return: filtered array with the same shape as x
+        """
+        if len(self.specs) == 0:
+            return x.copy()
+
+        if x.ndim == 1:
+            y, zf = signal.sosfilt(self.sos, x, zi=self.zi[:, :, 0])
+            self.zi[:, :, 0] = zf
+            return y
+
+        y, self.zi = signal.sosfilt(self.sos, x, axis=0, zi=self.zi)
         return y
+
+
+class BiquadFilter(FilterBank):
+    """
+    Stateful biquad that keeps its delay line across calls, so consecutive chunks are filtered as one
+    continuous signal. A FilterBank with a single section
+    """
+    def __init__(self, filter_type: FilterType, fc, fs, Q=0.707, gain=1, channels=1):
+        super().__init__([FilterSpec(filter_type, fc, Q, gain)], fs, channels)
+        self.filter_type = filter_type
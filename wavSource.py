@@ -0,0 +1,131 @@
+"""
+Author: Raghavasimhan Sankaranarayanan
+Date created: 03/03/24
+"""
+
+import os
+import struct
+import numpy as np
+from exceptions import *
+
+
+class WavSource:
+    """
+    Read-only WAV file whose PCM data chunk is exposed as an np.memmap with shape (num_frames, channels).
+    Chunks are zero-copy slices of the map, and the read cursor can be moved to any frame in O(1).
+    """
+    WAVE_FORMAT_PCM = 1
+    WAVE_FORMAT_IEEE_FLOAT = 3
+    WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+    def __init__(self, path: str):
+        self.path = path
+        self.fs, self.channels, self.sampwidth, fmt, offset, size = self.parse_header(path)
+        dtype = self.format2dtype(fmt, self.sampwidth)
+
+        num_frames = size // (self.channels * self.sampwidth)
+        if num_frames > 0:
+            self.data = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(num_frames, self.channels))
+        else:
+            self.data = np.zeros((0, self.channels), dtype=dtype)
+        self.idx = 0
+
+    @classmethod
+    def from_array(cls, data: np.ndarray, fs: int, path: str = None):
+        """
+        Wrap audio that is already in memory, e.g. from AudioCache, with its own read cursor
+        :param data: samples with shape (num_frames, channels)
+        """
+        src = cls.__new__(cls)
+        src.path = path
+        src.fs = fs
+        src.channels = data.shape[1]
+        src.sampwidth = data.dtype.itemsize
+        src.data = data
+        src.idx = 0
+        return src
+
+    @property
+    def num_frames(self):
+        return len(self.data)
+
+    @property
+    def duration(self):
+        return self.num_frames / self.fs
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    @staticmethod
+    def format2dtype(fmt: int, sampwidth: int):
+        if fmt == WavSource.WAVE_FORMAT_PCM:
+            if sampwidth == 1:
+                return np.dtype(np.uint8)
+            if sampwidth == 2:
+                return np.dtype('<i2')
+            if sampwidth == 4:
+                return np.dtype('<i4')
+        elif fmt == WavSource.WAVE_FORMAT_IEEE_FLOAT and sampwidth == 4:
+            return np.dtype('<f4')
+        raise IllegalValueException(f"Unsupported wav format {fmt} with sample width {sampwidth}")
+
+    @staticmethod
+    def parse_header(path: str):
+        """
+        Walk the RIFF chunks once to find the format and the location of the PCM data
+        :return: sample rate, channels, sample width in bytes, format tag, data offset and data size in bytes
+        """
+        file_size = os.path.getsize(path)
+        fmt = None
+        with open(path, "rb") as f:
+            riff, _, wave = struct.unpack("<4sI4s", f.read(12))
+            if riff != b"RIFF" or wave != b"WAVE":
+                raise IllegalValueException(f"{path} is not a RIFF/WAVE file")
+
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    break
+                chunk_id, chunk_size = struct.unpack("<4sI", header)
+
+                if chunk_id == b"fmt ":
+                    body = f.read(chunk_size)
+                    tag, channels, fs, _, _, bits = struct.unpack("<HHIIHH", body[:16])
+                    if tag == WavSource.WAVE_FORMAT_EXTENSIBLE and len(body) >= 26:
+                        tag = struct.unpack("<H", body[24:26])[0]
+                    fmt = tag, channels, fs, bits // 8
+                    if chunk_size % 2:
+                        f.seek(1, os.SEEK_CUR)
+
+                elif chunk_id == b"data":
+                    if fmt is None:
+                        raise IllegalValueException(f"{path} has no fmt chunk before its data chunk")
+                    offset = f.tell()
+                    # Streamed files can leave the size unset. Clamp it to what is actually on disk
+                    size = min(chunk_size, file_size - offset)
+                    tag, channels, fs, sampwidth = fmt
+                    return fs, channels, sampwidth, tag, offset, size
+
+                else:
+                    f.seek(chunk_size + (chunk_size % 2), os.SEEK_CUR)
+
+        raise IllegalValueException(f"{path} has no data chunk")
+
+    def seek(self, frame: int):
+        self.idx = min(max(int(frame), 0), self.num_frames)
+
+    def seek_sec(self, seconds: float):
+        self.seek(round(seconds * self.fs))
+
+    def tell(self):
+        return self.idx
+
+    def read(self, num_frames: int):
+        """
+        Return the next num_frames frames as a view of the map and advance the cursor.
+        The result is shorter than num_frames at the end of the file and empty after it.
+        """
+        data = self.data[self.idx:self.idx + num_frames]
+        self.idx += len(data)
+        return data